@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Usage:
+#
+#   bench/bench_diff.py [--hosts N] [--rows N] [-r REPEAT]
+#
+"""Measure "gethosts diff" on two generated results of configurable size.
+
+The results have ROWS rows per host (e.g. one per address), sorted as
+printed by gethosts. About 1% of the hosts are removed from the newer one,
+0.5% added and 1% changed. The latency (median of the repeats), the peak RSS
+of the process, the rows read and the rows per second are reported.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--hosts', type=int, default=1000000,
+                    help='number of hosts (default is %(default)s)')
+parser.add_argument('--rows', type=int, default=3,
+                    help='rows per host (default is %(default)s)')
+parser.add_argument('-r', type=int, dest='repeat', default=3,
+                    help='runs (default is %(default)s)')
+args = parser.parse_args()
+
+launcher = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'bin', 'gethosts')
+
+
+def generate(old, new):
+    """Write the older and newer results, and return their number of
+    rows."""
+
+    random.seed(0)
+    rows = 0
+    for i in range(args.hosts):
+        lines = ['host%07d.example.com\tlinux\t10.%d.%d.%d\n' %
+                 (i, i >> 16 & 255, i >> 8 & 255, j)
+                 for j in range(args.rows)]
+        r = random.random()
+        if r >= 0.01:
+            old.write(''.join(lines))
+            rows += len(lines)
+        if r < 0.99 or r >= 0.995:
+            if 0.5 <= r < 0.51:
+                lines[0] = lines[0].replace('linux', 'windows')
+            new.write(''.join(lines))
+            rows += len(lines)
+    return rows
+
+
+def run(old, new):
+    """Run gethosts diff once and return its latency, peak RSS (in bytes)
+    and the number of rows it printed."""
+
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, launcher, 'diff', old, new],
+                            stdout=subprocess.PIPE)
+    rows = 0
+    while True:
+        data = proc.stdout.read(1 << 16)
+        if not data:
+            break
+        rows += data.count(b'\n')
+    proc.stdout.close()
+
+    # Resource usage of this child only (RUSAGE_CHILDREN adds up all of them)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+
+    # 1 means the results differ
+    if os.waitstatus_to_exitcode(status) != 1:
+        sys.exit('gethosts diff failed with status %d' %
+                 os.waitstatus_to_exitcode(status))
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return elapsed, rss, rows
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix='bench_diff')
+    old = os.path.join(directory, 'old')
+    new = os.path.join(directory, 'new')
+
+    try:
+        with open(old, 'w') as f, open(new, 'w') as g:
+            rows = generate(f, g)
+
+        runs = [run(old, new) for _ in range(args.repeat)]
+        latency = statistics.median(run[0] for run in runs)
+        print('%10s %10s %10s %10s %12s' %
+              ('rows', 'latency', 'peak RSS', 'printed', 'rows/s'))
+        print('%10d %8.3f s %7.1f MB %10d %12.0f' %
+              (rows, latency, max(run[1] for run in runs) / 1e6, runs[0][2],
+               rows / latency))
+
+    finally:
+        for path in (old, new):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+
+main()
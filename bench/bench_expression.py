@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Usage:
+#
+#   bench/bench_expression.py [-n TIMES]
+#
+"""Measure the time gethosts takes to compile filter expressions.
+
+Each expression is compiled without the cache (parsing, rewriting and SQL
+generation) and with it (normalization and lookup only).
+"""
+
+import os
+import timeit
+import argparse
+import importlib.util
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('-n', type=int, dest='times', default=10000,
+                    help='number of compilations (default is %(default)s)')
+args = parser.parse_args()
+
+spec = importlib.util.spec_from_file_location(
+    'gethosts', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'bin', 'gethosts.py'))
+gethosts = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gethosts)
+
+expressions = [
+    'osname like "%linux%"',
+    'site like zurich or site like geneva or site like basel',
+    '(software like "openssh%" and swver like "7.%") or not ip like "10.%"',
+    'not (entity like prod and (status = retired or model in (a, b, c)))'
+    ' and host like "web%"',
+]
+
+semi = frozenset(gethosts.multivalued)
+
+for expr in expressions:
+    uncached = timeit.timeit(
+        lambda: gethosts.compile_normalized.__wrapped__(expr, '', '', semi),
+        number=args.times)
+    cached = timeit.timeit(
+        lambda: gethosts.compile_expression(expr, '', '', semi),
+        number=args.times)
+    print('%8.1f us %8.1f us (cached)  %s' % (
+        uncached / args.times * 1e6, cached / args.times * 1e6, expr))
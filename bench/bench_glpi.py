@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Usage:
+#
+#   bench/bench_glpi.py [--scale FACTOR] [--db FILE] [-r REPEAT]
+#
+"""Measure gethosts on a synthetic GLPI inventory of configurable size.
+
+The inventory is generated into a SQLite file with the tables and indexes of
+a snapshot (see "gethosts sync"), then a fixed set of gethosts invocations
+is run on it with --snapshot. For each one, the latency (median of the
+repeats), the peak RSS of the process, the rows printed and the rows per
+second are reported.
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+import importlib.util
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--computers', type=int, default=100000,
+                    help='number of computers (default is %(default)s)')
+parser.add_argument('--installs', type=int, default=5000000,
+                    help='number of software installations (default is '
+                         '%(default)s)')
+parser.add_argument('--ports', type=int, default=300000,
+                    help='number of network ports (default is %(default)s)')
+parser.add_argument('--scale', type=float, default=1.0, metavar='FACTOR',
+                    help='multiply the sizes above by FACTOR (default is '
+                         '%(default)s)')
+parser.add_argument('--db', type=str, metavar='FILE',
+                    help='generate the inventory into FILE and keep it (an '
+                         'existing FILE is reused as is)')
+parser.add_argument('-r', type=int, dest='repeat', default=3,
+                    help='runs of each invocation (default is %(default)s)')
+args = parser.parse_args()
+
+bindir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+
+# Number of rows of the small tables
+dimensions = {
+    'glpi_operatingsystems': 40,
+    'glpi_operatingsystemversions': 200,
+    'glpi_locations': 500,
+    'glpi_domains': 20,
+    'glpi_computermodels': 300,
+    'glpi_computertypes': 10,
+    'glpi_manufacturers': 30,
+    'glpi_states': 8,
+    'glpi_entities': 40,
+    'glpi_users': 5000,
+    'glpi_groups': 300,
+}
+
+# Invocations run on the inventory (name and gethosts arguments)
+invocations = [
+    ('hosts', []),
+    ('list osname', ['-l', 'osname']),
+    ('list software', ['-l', 'software']),
+    ('fields', ['-f', 'osname', '-f', 'site', '-f', 'model', '-f', 'entity']),
+    ('software filter', ['--software', 'openssh', '-f', 'swver']),
+    ('network filter', ['--ip', '10.1.%', '-f', 'mac']),
+    ('network cidr', ['--ip', '10.1.0.0/16', '-f', 'mac']),
+    ('software fields', ['-f', 'software', '-f', 'swver']),
+    ('network fields', ['-f', 'ip', '-f', 'netmask', '-f', 'gateway']),
+    ('show dups', ['--show-dups', '-f', 'software']),
+    ('no sort', ['--no-sort', '-f', 'ip']),
+    ('chunked', ['--chunk-size', '1000', '-f', 'ip']),
+    ('expression', ['-f', 'osname',
+                    'osname like "linux%" and not site in (site1, site2)']),
+    ('aggregate', ['--aggregate', '-f', 'software', '-f', 'ip']),
+    ('group by', ['--group-by', 'osname,site']),
+    ('inventory', ['--inventory', 'site,osname', '-f', 'ip']),
+    ('jsonl', ['--format', 'jsonl', '-f', 'osname', '-f', 'ip']),
+]
+
+DATE = '2020-04-21 00:00:00'
+
+
+def generate(path, computers, installs, ports):
+    """Create the snapshot tables in path and fill them with random rows."""
+
+    spec = importlib.util.spec_from_file_location(
+        'gethosts', os.path.join(bindir, 'gethosts.py'))
+    gethosts = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gethosts)
+
+    random.seed(0)
+    db = sqlite3.connect(path)
+
+    # Same tables and indexes as created by "gethosts sync"
+    for table, columns in gethosts.SNAPSHOT_TABLES.items():
+        db.execute('create table %s (%s, primary key (id))' %
+                   (table, ', '.join(columns)))
+        for column in columns:
+            if column == 'name' or column.endswith('_id'):
+                db.execute('create index %s_%s on %s (%s)' %
+                           (table, column, table, column))
+            elif column.endswith('_0'):
+                words = column[:-2]
+                db.execute('create index %s_%s on %s (%s)' %
+                           (table, words, table, ', '.join(
+                               '%s_%d' % (words, i) for i in range(4))))
+        if table == 'glpi_computers':
+            db.execute('create index %s_name_order on %s (%s, id)' %
+                       (table, table, gethosts.SNAPSHOT_ORDER % 'name'))
+
+    def insert(table, rows):
+        db.executemany('insert into %s values (%s)' % (table, ', '.join(
+            '?' * len(gethosts.SNAPSHOT_TABLES[table]))), rows)
+
+    for table, count in dimensions.items():
+        prefix = table.split('_')[1][:-1]
+        if table == 'glpi_operatingsystems':
+            # A few well-known names for the filters
+            names = ['linux', 'linux debian', 'linux centos', 'windows']
+        else:
+            names = []
+        names += ['%s%d' % (prefix, i) for i in range(len(names), count)]
+        insert(table, ((i, name, DATE)
+                       for i, name in enumerate(names, 1)))
+
+    def dimension(table):
+        return random.randint(1, dimensions[table])
+
+    insert('glpi_computers', (
+        (i, '%s%06d.example.com' % (random.choice(('web', 'db', 'app')), i),
+         'SN%08d' % i, '%032x' % random.getrandbits(128),
+         int(random.random() < 0.02),
+         dimension('glpi_locations'), dimension('glpi_domains'),
+         dimension('glpi_computermodels'), dimension('glpi_computertypes'),
+         dimension('glpi_manufacturers'), dimension('glpi_states'),
+         dimension('glpi_entities'), dimension('glpi_users'),
+         dimension('glpi_groups'), dimension('glpi_users'),
+         dimension('glpi_groups'), DATE, DATE)
+        for i in range(1, computers + 1)))
+    insert('glpi_items_operatingsystems', (
+        (i, i, dimension('glpi_operatingsystems'),
+         dimension('glpi_operatingsystemversions'), DATE)
+        for i in range(1, computers + 1)))
+
+    # About 30 versions per software
+    softwares = max(installs // 2500, 10)
+    versions = softwares * 30
+    insert('glpi_softwares', (
+        (i, 'openssh' if i == 1 else 'software%d' % i, 0, DATE)
+        for i in range(1, softwares + 1)))
+    insert('glpi_softwareversions', (
+        (i, (i - 1) % softwares + 1, '%d.%d' % (i % 10, i // softwares), DATE)
+        for i in range(1, versions + 1)))
+    insert('glpi_computers_softwareversions', (
+        (i, random.randint(1, computers), random.randint(1, versions),
+         int(random.random() < 0.01))
+        for i in range(1, installs + 1)))
+
+    # Words of an IPv4 address as stored by GLPI (mapped into IPv6)
+    def words(address):
+        a, b, c, d = map(int, address.split('.'))
+        return 0, 0, 0xffff, a << 24 | b << 16 | c << 8 | d
+
+    # One name and address per port, in one of 1000 /24 networks
+    networks = 1000
+    insert('glpi_ipnetworks', (
+        (i, '10.%d.%d.0' % divmod(i, 256), '255.255.255.0',
+         '10.%d.%d.1' % divmod(i, 256), DATE,
+         *words('10.%d.%d.0' % divmod(i, 256)),
+         *words('10.%d.%d.1' % divmod(i, 256)))
+        for i in range(1, networks + 1)))
+    ports = [(i, random.randint(1, computers),
+              random.randint(1, networks)) for i in range(1, ports + 1)]
+    insert('glpi_networkports', (
+        (i, computer, 'Computer', 0, 'eth%d' % (i % 4),
+         '52:54:00:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+         DATE)
+        for i, computer, network in ports))
+    insert('glpi_networknames', ((i, i, DATE) for i, _, _ in ports))
+    addresses = ('10.%d.%d.%d' % (network // 256, network % 256, i % 250 + 2)
+                 for i, _, network in ports)
+    insert('glpi_ipaddresses', (
+        (i, i, address, *words(address))
+        for i, address in enumerate(addresses, 1)))
+    insert('glpi_ipaddresses_ipnetworks', (
+        (i, i, network) for i, _, network in ports))
+
+    db.execute('analyze')
+    db.commit()
+    db.close()
+
+
+def run(path, argv):
+    """Run gethosts once and return its latency, peak RSS (in bytes) and the
+    number of rows it printed."""
+
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(bindir, 'gethosts'),
+                             '--snapshot', path, '--no-daemon'] + argv,
+                            stdout=subprocess.PIPE)
+    rows = 0
+    while True:
+        data = proc.stdout.read(1 << 16)
+        if not data:
+            break
+        rows += data.count(b'\n')
+    proc.stdout.close()
+
+    # Resource usage of this child only (RUSAGE_CHILDREN adds up all of them)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        sys.exit('gethosts %s failed with status %d' %
+                 (' '.join(argv), proc.returncode))
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return elapsed, rss, rows
+
+
+def main():
+    path = args.db
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='bench_glpi')
+        os.close(fd)
+        os.remove(path)
+
+    try:
+        if not os.path.exists(path):
+            sizes = [max(int(n * args.scale), 1)
+                     for n in (args.computers, args.installs, args.ports)]
+            # In another process: the peak RSS of a child includes the
+            # memory of its parent when it was forked, so ours must stay low
+            start = time.perf_counter()
+            proc = multiprocessing.get_context('fork').Process(
+                target=generate, args=(path,) + tuple(sizes))
+            proc.start()
+            proc.join()
+            if proc.exitcode:
+                sys.exit('cannot generate the inventory in %s' % path)
+            print('Generated %d computers, %d installs and %d ports in %.1f s'
+                  % (*sizes, time.perf_counter() - start))
+
+        print('%-16s %10s %10s %10s %12s' %
+              ('invocation', 'latency', 'peak RSS', 'rows', 'rows/s'))
+        for name, argv in invocations:
+            runs = [run(path, argv) for _ in range(args.repeat)]
+            latency = statistics.median(run[0] for run in runs)
+            rss = max(run[1] for run in runs)
+            rows = runs[0][2]
+            print('%-16s %8.3f s %7.1f MB %10d %12.0f' %
+                  (name, latency, rss / 1e6, rows, rows / latency))
+
+    finally:
+        if args.db is None and os.path.exists(path):
+            os.remove(path)
+
+
+main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Usage:
+#
+#   bench/bench_output.py [-n ROWS] [-c COLUMNS]
+#
+"""Measure the output throughput (rows per second) of gethosts.
+
+Rows come from a fake cursor, so only the Python side of the output (the
+formatting and writing done by write_rows, or by the writers of --format) is
+measured. The Arrow and Parquet formats are only measured if pyarrow is
+installed.
+"""
+
+import os
+import time
+import argparse
+import importlib.util
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('-n', type=int, dest='rows', default=1000000,
+                    help='number of rows (default is %(default)s)')
+parser.add_argument('-c', type=int, dest='columns', default=4,
+                    help='number of columns (default is %(default)s)')
+args = parser.parse_args()
+
+spec = importlib.util.spec_from_file_location(
+    'gethosts', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'bin', 'gethosts.py'))
+gethosts = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gethosts)
+
+
+class FakeCursor:
+    """A cursor returning the same rows (with some NULL values) n times."""
+
+    def __init__(self, n, columns):
+        self.left = n
+        self.row = tuple(['host%d' % i if i % 3 else None
+                          for i in range(columns)])
+        self.row = ('host.example.com',) + self.row[1:]
+        self.description = [('column%d' % i,) for i in range(columns)]
+
+    def fetchmany(self, size):
+        size = min(size, self.left)
+        self.left -= size
+        return [self.row] * size
+
+
+def bench(name, columns, write):
+    """Print the throughput of one output format, printed by
+    write(cursor, out)."""
+
+    with open(os.devnull, 'wb') as out:
+        start = time.perf_counter()
+        write(FakeCursor(args.rows, columns), out)
+        elapsed = time.perf_counter() - start
+
+    print('%-12s %10.0f rows/s' % (name, args.rows / elapsed))
+
+
+bench('tab', args.columns,
+      lambda cursor, out: gethosts.write_rows(cursor, out, '\t', False))
+bench('csv', args.columns,
+      lambda cursor, out: gethosts.write_rows(cursor, out, '\t', True))
+bench('csv single', 1,
+      lambda cursor, out: gethosts.write_rows(cursor, out, '\t', True))
+bench('jsonl', args.columns, gethosts.write_jsonl)
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+if pyarrow:
+    bench('arrow', args.columns,
+          lambda cursor, out: gethosts.write_arrow(cursor, out, False))
+    bench('parquet', args.columns,
+          lambda cursor, out: gethosts.write_arrow(cursor, out, True))
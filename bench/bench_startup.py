@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Usage:
+#
+#   bench/bench_startup.py [-r REPEAT] [--limit TIMES]
+#
+"""Measure the startup time of gethosts on the paths that don't query.
+
+Each invocation is run through the bin/gethosts launcher, in a temporary
+HOME with a fresh completion cache and result cache: COLD times cold (the
+first run after compiling the bytecode of gethosts.py, as when installing),
+then REPEAT times warm (the invocations taking turns with the bare
+interpreter, "python -c pass", so they share the noise of the machine). Its
+cold (median), fastest and median times are reported with its slowest
+imports, as listed by "python -X importtime", and its cold time in times
+the median one of the bare interpreter. The run fails if an invocation
+imports the MySQL driver, or if its cold time is over the limit, in times
+the bare interpreter, so that the limit doesn't depend on the speed of the
+machine (the default is 40 ms where the bare interpreter starts in 10 ms).
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import statistics
+import subprocess
+import tempfile
+import py_compile
+import importlib.util
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('-r', type=int, dest='repeat', default=20,
+                    help='runs of each invocation (default is %(default)s)')
+parser.add_argument('--limit', type=float, default=4, metavar='TIMES',
+                    help='maximum cold startup time, in times that of the '
+                         'bare interpreter (default is %(default)s)')
+args = parser.parse_args()
+
+# Cold runs of each invocation
+COLD = 3
+
+bindir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+launcher = os.path.join(bindir, 'gethosts')
+
+
+def invocations(snapshot):
+    """Return the invocations measured (name and gethosts arguments)."""
+
+    return [
+        ('version', ['--version']),
+        ('help', ['--help']),
+        ('complete', ['--complete', 'site', 'zu']),
+        ('cache hit', ['--snapshot', snapshot, '--cache', '3600',
+                       '-f', 'site']),
+    ]
+
+
+def prime(snapshot):
+    """Return the arguments caching the result read by the cache hit."""
+
+    return ['--snapshot', snapshot, '--cache', '3600', '--refresh',
+            '-f', 'site']
+
+
+def prepare(home, snapshot):
+    """Create an empty snapshot and the completion cache of sites in home."""
+
+    spec = importlib.util.spec_from_file_location(
+        'gethosts', os.path.join(bindir, 'gethosts.py'))
+    gethosts = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gethosts)
+
+    db = sqlite3.connect(snapshot)
+    for table, columns in gethosts.SNAPSHOT_TABLES.items():
+        db.execute('create table %s (%s, primary key (id))' %
+                   (table, ', '.join(columns)))
+    db.commit()
+    db.close()
+
+    cachedir = os.path.join(home, '.cache', 'gethosts')
+    os.makedirs(cachedir)
+    with open(os.path.join(cachedir, 'complete-site'), 'w') as f:
+        f.write(''.join('%s\n' % site for site in sorted(
+            ['basel', 'geneva', 'zug', 'zurich'] +
+            ['site%d' % i for i in range(1000)])))
+
+
+def run(argv, env, importtime=False, script=launcher):
+    """Run gethosts (or another script) once and return its time (and the
+    stderr of python -X importtime)."""
+
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else [])
+    start = time.perf_counter()
+    proc = subprocess.run(cmd + [script] + argv, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        sys.exit('gethosts %s failed with status %d' %
+                 (' '.join(argv), proc.returncode))
+    return elapsed, proc.stderr.decode()
+
+
+def imports(stderr):
+    """Return the (self time in us, name) of the modules listed by python
+    -X importtime, slowest first."""
+
+    modules = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            us, _, name = line[len('import time:'):].split('|')
+            if us.strip().isdigit():
+                modules.append((int(us), name.strip()))
+    return sorted(modules, reverse=True)
+
+
+def main():
+    home = tempfile.mkdtemp(prefix='bench_startup')
+    snapshot = os.path.join(home, 'snapshot.db')
+    env = dict(os.environ, HOME=home)
+    cases = invocations(snapshot)
+    times = {name: [] for name, _ in cases}
+    bare = []
+    cold = {name: [] for name, _ in cases}
+    results = {}
+
+    try:
+        prepare(home, snapshot)
+
+        # The result of the cache hit cached by another invocation
+        run(prime(snapshot), env)
+
+        # Compiled as when installing (runs don't write the bytecode if
+        # PYTHONDONTWRITEBYTECODE is set)
+        for _ in range(COLD):
+            py_compile.compile(os.path.join(bindir, 'gethosts.py'),
+                               doraise=True)
+            for name, argv in cases:
+                cold[name].append(run(argv, env)[0])
+        cold = {name: statistics.median(runs) for name, runs in cold.items()}
+
+        for _ in range(args.repeat):
+            bare.append(run(['pass'], env, script='-c')[0])
+            for name, argv in cases:
+                times[name].append(run(argv, env)[0])
+        for name, argv in cases:
+            results[name] = imports(run(argv, env, importtime=True)[1])
+
+    finally:
+        shutil.rmtree(home)
+
+    status = 0
+    python = statistics.median(bare)
+    print('%-12s %10s %10s %10s %8s  %s' % ('invocation', 'cold', 'fastest',
+                                            'median', 'python',
+                                            'slowest imports'))
+    print('%-12s %10s %7.1f ms %7.1f ms %7.1f x' % (
+        'python', '', min(bare) * 1e3, python * 1e3, 1))
+    for name, _ in cases:
+        modules = results[name]
+        ratio = cold[name] / python
+        print('%-12s %7.1f ms %7.1f ms %7.1f ms %7.1f x  %s' %
+              (name, cold[name] * 1e3, min(times[name]) * 1e3,
+               statistics.median(times[name]) * 1e3, ratio,
+               ', '.join('%s %.1f' % (module, us / 1e3)
+                         for us, module in modules[:3])))
+        if any(module.startswith('MySQLdb') for _, module in modules):
+            print('%s: imports the MySQL driver' % name, file=sys.stderr)
+            status = 1
+        if ratio > args.limit:
+            print('%s: cold start slower than %g times the bare interpreter'
+                  % (name, args.limit), file=sys.stderr)
+            status = 1
+
+    return status
+
+
+sys.exit(main())
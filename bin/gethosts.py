@@ -37,15 +37,28 @@
 
 __version__ = 2.0
 
+import os
 import sys
-import argparse
-import shlex
-import MySQLdb as mdb
-from MySQLdb import cursors
-import warnings
-
-# treat MySQL warnings as errors
-warnings.filterwarnings('error', category=mdb.Warning)
+import time
+import bisect
+import fcntl
+import io
+import _thread
+import unicodedata
+import itertools
+import functools
+import collections
+import struct
+
+# Modules only used by some commands or options (the daemon, batch mode,
+# --backends, the argument parsers, etc.) are imported by the functions using
+# them, so a call like those of the completion doesn't pay for them (see
+# bench/bench_startup.py).
+
+# The MySQL driver is only imported when connecting to the database (see
+# mysql_connect()), so completion and snapshot queries don't pay for it
+mdb = None
+cursors = None
 
 # Return codes
 OK = 0
@@ -61,102 +74,578 @@ description = "Print lists of hosts from the GLPI inventory database."
 # select Computers in this script, we need to force its type here.
 itemtype = 'Computer'
 
+# Default location of the local inventory snapshot (see "gethosts sync").
+SNAPSHOT = '/var/cache/gethosts/snapshot.db'
+
+# Sort key of the hostnames on a snapshot: the order of the database for
+# ASCII names (see host_key())
+SNAPSHOT_ORDER = "replace(%s, '_', '!') collate nocase"
+
+# Number of rows fetched (and printed) at once
+BATCH = 1000
+
+# Number of rows of a record batch of the Arrow and Parquet outputs (a row
+# group in Parquet, so it is better not too small)
+ARROW_BATCH = 65536
+
+# Number of times a page of --chunk-size is fetched again after losing the
+# connection (on a new one), and the MySQL errors meaning it was lost
+CHUNK_RETRIES = 3
+LOST_CONNECTION = (2006, 2013)
+
+# Directory and time to live (in seconds) of the bash completion cache (see
+# "gethosts --complete"). Stale entries are refreshed in the background.
+CACHEDIR = os.path.expanduser('~/.cache/gethosts')
+COMPLETE_TTL = 300
+
+# Time to live (in seconds) of the query results cached in CACHEDIR (0 only
+# caches the queries given --cache) and total size of the cached results.
+# The least recently used results are removed when the cache is full.
+RESULT_TTL = 0
+RESULT_CACHE_SIZE = 64 << 20
+
+# Unix socket of the query daemon (see "gethosts daemon") and number of
+# connections it keeps open. If the daemon is running, gethosts sends its
+# queries to it instead of connecting to the database.
+DAEMON_SOCKET = '/run/gethosts/gethostsd.sock'
+DAEMON_POOL = 4
+
+# Databases queried in parallel with --backends: one section per backend (its
+# name) with the server, port, user, password and database settings (those
+# not given default to the DBxxx settings below).
+BACKENDS = '/etc/gethosts/backends.conf'
+
+# Time (in seconds) the names of the dimension tables (locations, entities,
+# models, etc.) are cached before checking if they changed in the database.
+# Filters on those names are resolved to ids using that cache.
+DIMENSION_TTL = 60
+
+# Tables (and their columns) copied into the local SQLite snapshot by
+# "gethosts sync". Tables with a date_mod column are synced incrementally, all
+# others are copied in full on every sync.
+SNAPSHOT_TABLES = {
+    'glpi_computers': ('id', 'name', 'serial', 'uuid', 'is_deleted',
+                       'locations_id', 'domains_id', 'computermodels_id',
+                       'computertypes_id', 'manufacturers_id', 'states_id',
+                       'entities_id', 'users_id', 'groups_id',
+                       'users_id_tech', 'groups_id_tech', 'date_mod',
+                       'date_creation'),
+    'glpi_items_operatingsystems': ('id', 'items_id', 'operatingsystems_id',
+                                    'operatingsystemversions_id', 'date_mod'),
+    'glpi_operatingsystems': ('id', 'name', 'date_mod'),
+    'glpi_operatingsystemversions': ('id', 'name', 'date_mod'),
+    'glpi_locations': ('id', 'name', 'date_mod'),
+    'glpi_domains': ('id', 'name', 'date_mod'),
+    'glpi_computermodels': ('id', 'name', 'date_mod'),
+    'glpi_computertypes': ('id', 'name', 'date_mod'),
+    'glpi_manufacturers': ('id', 'name', 'date_mod'),
+    'glpi_states': ('id', 'name', 'date_mod'),
+    'glpi_entities': ('id', 'name', 'date_mod'),
+    'glpi_users': ('id', 'name', 'date_mod'),
+    'glpi_groups': ('id', 'name', 'date_mod'),
+    'glpi_computers_softwareversions': ('id', 'computers_id',
+                                        'softwareversions_id', 'is_deleted'),
+    'glpi_softwareversions': ('id', 'softwares_id', 'name', 'date_mod'),
+    'glpi_softwares': ('id', 'name', 'is_deleted', 'date_mod'),
+    'glpi_networkports': ('id', 'items_id', 'itemtype', 'is_recursive',
+                          'name', 'mac', 'date_mod'),
+    'glpi_networknames': ('id', 'items_id', 'date_mod'),
+    'glpi_ipaddresses': ('id', 'items_id', 'name', 'binary_0', 'binary_1',
+                         'binary_2', 'binary_3'),
+    'glpi_ipaddresses_ipnetworks': ('id', 'ipaddresses_id', 'ipnetworks_id'),
+    'glpi_ipnetworks': ('id', 'address', 'netmask', 'gateway', 'date_mod',
+                        'address_0', 'address_1', 'address_2', 'address_3',
+                        'gateway_0', 'gateway_1', 'gateway_2', 'gateway_3'),
+}
+
 # -----------------------------------------------------------------------------
 # -- DON'T CHANGE ANYTHING BELOW THIS LINE UNLESS YOU KNOW WHAT YOU'RE DOING --
 
-parser = argparse.ArgumentParser(description=description)
-
-parser.add_argument('-v', '--version', action='version', version=version)
-
-parser.add_argument('-d', '--debug', action='store_true', dest='debug',
-                    default=False,
-                    help='enable debug mode (developers only)',)
-
-group = parser.add_argument_group('filter options')
-
-group.add_argument('-l', action='store', dest='list',
-                   choices=['osname', 'osver', 'site', 'domain',
-                            'model', 'type', 'vendor',
-                            'status', 'entity',
-                            'user', 'group',
-                            'software',
-                            'ip', 'mac', 'netmask', 'subnet', 'gateway'],
-                   help='show list by name')
-group.add_argument('--host', type=str, dest='hostname',
-                   help='device hostname',)
-group.add_argument('--osname', type=str, dest='osname',
-                   help='operating system name',)
-group.add_argument('--osver', type=str, dest='osver',
-                   help='operating system version',)
-group.add_argument('--site', type=str, dest='site',
-                   help='host location',)
-group.add_argument('--domain', type=str, dest='domain',
-                   help='host domain',)
-group.add_argument('--model', type=str, dest='model',
-                   help='host hardware model',)
-group.add_argument('--type', type=str, dest='type',
-                   help='host hardware type',)
-group.add_argument('--vendor', type=str, dest='vendor',
-                   help='host vendor (manufacturer)',)
-group.add_argument('--status', type=str, dest='status',
-                   help='host status',)
-group.add_argument('--entity', type=str, dest='entity',
-                   help='host platform (entity)',)
-group.add_argument('--user', type=str, dest='user',
-                   help='host owner (user)',)
-group.add_argument('--group', type=str, dest='group',
-                   help='host department (group)',)
-group.add_argument('--techuser', type=str, dest='techuser', metavar='TUSER',
-                   help='host technical owner (user)',)
-group.add_argument('--techgroup', type=str, dest='techgroup', metavar='TGROUP',
-                   help='host technical department (group)',)
-group.add_argument('--software', type=str, dest='software', metavar='SWNAME',
-                   help='software name',)
-group.add_argument('--mac', type=str, dest='mac',
-                   help='host MAC address',)
-group.add_argument('--ip', type=str, dest='ip',
-                   help='host IP address',)
-group.add_argument('--netmask', type=str, dest='netmask',
-                   help='host netmask address',)
-group.add_argument('--subnet', type=str, dest='subnet',
-                   help='host subnet address',)
-group.add_argument('--gateway', type=str, dest='gateway',
-                   help='host default gateway address',)
-group.add_argument('--case-sensitive', action='store_true', dest='binary',
-                   default=False,
-                   help='case sensite search (does not apply to expr filter)',)
-group.add_argument(dest='expr', nargs=argparse.REMAINDER, metavar='expression',
-                   help='filter criteria expression')
-
-group = parser.add_argument_group('formatting options')
-group.add_argument('-f', type=str, action='append', dest='field',
-                   choices=['serial', 'uuid',
-                            'osname', 'osver', 'site', 'domain',
-                            'model', 'type', 'vendor',
-                            'status', 'entity',
-                            'user', 'group', 'techuser', 'techgroup',
-                            'software', 'swver',
-                            'ifname', 'mac',
-                            'ip', 'netmask', 'subnet', 'gateway'],
-                   help='field to display (multiple options are allowed). ')
-group.add_argument('-s', '--separator', dest='sep', default='\t',
-                   help='output field separator (default is TAB)',)
-group.add_argument('--no-sort', action='store_true', dest='nosort',
-                   default=False,
-                   help='do not sort the result',)
-group.add_argument('--show-dups', action='store_true', dest='dups',
-                   default=False,
-                   help='show duplicates in the resulut (if any)',)
-group.add_argument('--csv', action='store_true', dest='csv', default=False,
-                   help='Comma Separated Values output (overrides -s unless '
-                        'specified). If result has only one column, output '
-                        'will be displayed on a single line.',)
-
-args = parser.parse_args()
-
-# Disable traceback if not in debug mode
-if not args.debug:
-    sys.tracebacklimit = 0
+# Fields which can be displayed (-f) or filtered on (--xxx options and the
+# expression). Each one maps to the table alias it comes from (see joins
+# below), the column and the label used in the select clause.
+fields = {
+    'host': ('c', 'name', 'name'),
+    'serial': ('c', 'serial', 'serial'),
+    'uuid': ('c', 'uuid', 'uuid'),
+    'osname': ('os', 'name', 'osname'),
+    'osver': ('osv', 'name', 'osver'),
+    'site': ('l', 'name', 'location'),
+    'domain': ('d', 'name', 'domain'),
+    'model': ('cm', 'name', 'model'),
+    'type': ('ct', 'name', 'type'),
+    'vendor': ('m', 'name', 'vendor'),
+    'status': ('s', 'name', 'status'),
+    'entity': ('e', 'name', 'entity'),
+    'user': ('u', 'name', 'user'),
+    'group': ('g', 'name', 'group'),
+    'techuser': ('tu', 'name', 'techuser'),
+    'techgroup': ('tg', 'name', 'techgroup'),
+    'software': ('sw', 'name', 'software'),
+    'swver': ('sv', 'name', 'swver'),
+    'ifname': ('np', 'name', 'ifname'),
+    'mac': ('np', 'mac', 'mac'),
+    'ip': ('ip', 'name', 'ip'),
+    'netmask': ('ipn', 'netmask', 'netmask'),
+    'subnet': ('ipn', 'address', 'subnet'),
+    'gateway': ('ipn', 'gateway', 'gateway'),
+}
+
+# Tables joined to glpi_computers (alias c) when one of their fields is used.
+# Each alias maps to the alias it is joined on and to the join clause. Joins
+# are emitted in this order, so dependencies must come first.
+joins = {                                         # table alias down here vvv
+    'ios': ('c', ' left join glpi_items_operatingsystems as ios'        # ios
+                 ' on (c.id = ios.items_id)'),
+    'os': ('ios', ' left join glpi_operatingsystems as os'              # os
+                  ' on (ios.operatingsystems_id = os.id)'),
+    'osv': ('ios', ' left join glpi_operatingsystemversions as osv'     # osv
+                   ' on (ios.operatingsystemversions_id = osv.id)'),
+    'l': ('c', ' left join glpi_locations as l'                         # l
+               ' on (c.locations_id = l.id)'),
+    'd': ('c', ' left join glpi_domains as d'                           # d
+               ' on (c.domains_id = d.id)'),
+    'cm': ('c', ' left join glpi_computermodels as cm'                  # cm
+                ' on (c.computermodels_id = cm.id)'),
+    'ct': ('c', ' left join glpi_computertypes as ct'                   # ct
+                ' on (c.computertypes_id = ct.id)'),
+    'm': ('c', ' left join glpi_manufacturers as m'                     # m
+               ' on (c.manufacturers_id = m.id)'),
+    's': ('c', ' left join glpi_states as s on (c.states_id = s.id)'),  # s
+    'e': ('c', ' left join glpi_entities as e'                          # e
+               ' on (c.entities_id = e.id)'),
+    'u': ('c', ' left join glpi_users as u on (c.users_id = u.id)'),    # u
+    'g': ('c', ' left join glpi_groups as g on (c.groups_id = g.id)'),  # g
+    'tu': ('c', ' left join glpi_users as tu'                           # tu
+                ' on (c.users_id_tech = tu.id)'),
+    'tg': ('c', ' left join glpi_groups as tg'                          # tg
+                ' on (c.groups_id_tech = tg.id)'),
+    'csv': ('c', ' left join glpi_computers_softwareversions as csv'    # csv
+                 ' on (c.id = csv.computers_id)'),
+    'sv': ('csv', ' left join glpi_softwareversions as sv'              # sv
+                  ' on (csv.softwareversions_id = sv.id)'),
+    'sw': ('sv', ' left join glpi_softwares as sw'                      # sw
+                 ' on (sv.softwares_id = sw.id)'),
+    'np': ('c', ' left join glpi_networkports as np'                    # np
+                ' on (c.id = np.items_id)'),
+    'nn': ('np', ' left join glpi_networknames as nn'                   # nn
+                 ' on (np.id = nn.items_id)'),
+    'ip': ('nn', ' left join glpi_ipaddresses as ip'                    # ip
+                 ' on (nn.id = ip.items_id)'),
+    'ian': ('ip', ' left join glpi_ipaddresses_ipnetworks as ian'       # ian
+                  ' on (ip.id = ian.ipaddresses_id)'),
+    'ipn': ('ian', ' left join glpi_ipnetworks as ipn'                  # ipn
+                   ' on (ipn.id = ian.ipnetworks_id)'),
+}
+
+# Tables joined on glpi_computers with possibly many rows per host (software
+# and network ports). Each maps to the from clause and the condition used to
+# fetch the rows of a host in a subquery (semi-join or aggregate).
+multivalued = {
+    'csv': (' from glpi_computers_softwareversions as csv',
+            'csv.computers_id = c.id and csv.is_deleted = 0'),
+    'np': (' from glpi_networkports as np',
+           "np.items_id = c.id and np.itemtype = '%s' and np.is_recursive = 0"
+           % itemtype),
+}
+
+# Tables (by alias) with a date_mod column. In a change feed (see --since), a
+# host changed if the row of any of those tables joined for its fields and
+# filters was modified.
+modified = ['c', 'ios', 'os', 'osv', 'l', 'd', 'cm', 'ct', 'm', 's', 'e', 'u',
+            'g', 'tu', 'tg', 'sv', 'sw', 'np', 'nn', 'ipn']
+
+# Fields holding addresses, which GLPI also stores as four 32 bits words
+# (IPv4 addresses mapped to IPv6): the alias of their table and the prefix of
+# the columns of the words. Filters on them can be networks in CIDR notation
+# (see cidr_condition()).
+addresses = {
+    'ip': ('ip', 'binary'),
+    'subnet': ('ipn', 'address'),
+    'gateway': ('ipn', 'gateway'),
+}
+
+# Fields whose values come from a dimension table: the table and the foreign
+# key (alias and column) pointing to it. Filters on those fields are matched
+# against the cached names and run as filters on the ids (see resolve_ids()).
+dimensions = {
+    'osname': ('glpi_operatingsystems', 'ios', 'operatingsystems_id'),
+    'osver': ('glpi_operatingsystemversions', 'ios',
+              'operatingsystemversions_id'),
+    'site': ('glpi_locations', 'c', 'locations_id'),
+    'domain': ('glpi_domains', 'c', 'domains_id'),
+    'model': ('glpi_computermodels', 'c', 'computermodels_id'),
+    'type': ('glpi_computertypes', 'c', 'computertypes_id'),
+    'vendor': ('glpi_manufacturers', 'c', 'manufacturers_id'),
+    'status': ('glpi_states', 'c', 'states_id'),
+    'entity': ('glpi_entities', 'c', 'entities_id'),
+    'user': ('glpi_users', 'c', 'users_id'),
+    'group': ('glpi_groups', 'c', 'groups_id'),
+    'techuser': ('glpi_users', 'c', 'users_id_tech'),
+    'techgroup': ('glpi_groups', 'c', 'groups_id_tech'),
+}
+
+# Maximum number of ids a filter is resolved to (beyond, the table is joined)
+MAX_IDS = 1000
+
+# Cached names of the dimension tables (see resolve_ids()), and their lock
+# (from _thread, as threading is only imported by the commands using threads)
+dimension_cache = {}
+dimension_lock = _thread.allocate_lock()
+
+# Filter options (by dest) and the field they match, in the order they are
+# added to the where clause
+filters = [('hostname', 'host'), ('osname', 'osname'), ('osver', 'osver'),
+           ('site', 'site'), ('domain', 'domain'), ('model', 'model'),
+           ('type', 'type'), ('vendor', 'vendor'), ('status', 'status'),
+           ('entity', 'entity'), ('user', 'user'), ('group', 'group'),
+           ('techuser', 'techuser'), ('techgroup', 'techgroup'),
+           ('software', 'software'), ('ip', 'ip'), ('mac', 'mac'),
+           ('netmask', 'netmask'), ('subnet', 'subnet'),
+           ('gateway', 'gateway')]
+
+# Maximum number of prepared statements kept per connection (by the daemon and
+# batch mode) and the ids used to name them
+STATEMENTS = 64
+statement_ids = itertools.count()
+
+# Frame header of the daemon protocol (see FrameWriter)
+FRAME = struct.Struct('>cI')
+
+# Lists available with -l (and with --complete, which also accepts "host")
+# and their select clause (without the select keyword). Names are aliased,
+# so the order by isn't ambiguous on a snapshot (in SQLite).
+lists = {
+    'osname': ' t.name as name from glpi_operatingsystems as t',
+    'osver': ' t.name as name from glpi_operatingsystemversions as t',
+    'site': ' t.name as name from glpi_locations as t',
+    'domain': ' t.name as name from glpi_domains as t',
+    'model': ' t.name as name from glpi_computermodels as t',
+    'type': ' t.name as name from glpi_computertypes as t',
+    'vendor': ' t.name as name from glpi_manufacturers as t',
+    'status': ' t.name as name from glpi_states as t',
+    'entity': ' t.name as name from glpi_entities as t',
+    'user': ' t.name as name from glpi_users as t',
+    'group': ' t.name as name from glpi_groups as t',
+    'software': (' t.name as name from glpi_softwareversions as sv,'
+                 ' glpi_softwares as t'
+                 ' where sv.softwares_id = t.id'
+                 ' and t.is_deleted = 0'),
+}
+lists.update((f, " %s from glpi_networkports"
+                 " where itemtype = '%s' and is_recursive = 0" % (f, itemtype))
+             for f in ['ip', 'mac', 'netmask', 'subnet', 'gateway'])
+
+# Fields available with -f (all but the hostname, which is always shown)
+field_choices = [f for f in fields if f != 'host']
+
+# Parser and arguments of the command line (set by parse_args())
+parser = None
+args = None
+
+
+def timestamp(value):
+    """Return a --since timestamp (a date, or a date and time) in the format
+    of the dates in the database."""
+
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.strftime('%Y-%m-%d %H:%M:%S', time.strptime(value, fmt))
+        except ValueError:
+            pass
+
+    import argparse
+    raise argparse.ArgumentTypeError("invalid timestamp: '%s'" % value)
+
+
+def field_list(value):
+    """Return the list of fields of a comma separated --group-by (or
+    --inventory) value."""
+
+    import argparse
+
+    names = [name.strip() for name in value.split(',')]
+    for name in names:
+        if name not in fields:
+            raise argparse.ArgumentTypeError("invalid field: '%s'" % name)
+    return names
+
+
+def parse_args():
+    """Build the argument parsers and parse the command line into the
+    global args (not done at import, so the completion can answer before
+    it, see cli())."""
+
+    import argparse
+
+    global parser
+    global args
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.set_defaults(command=None)
+
+    parser.add_argument('-v', '--version', action='version', version=version)
+
+    parser.add_argument('-d', '--debug', action='store_true', dest='debug',
+                        default=False,
+                        help='enable debug mode (developers only)',)
+
+    parser.add_argument('--profile', action='store_true', dest='profile',
+                        default=False,
+                        help='print the time spent in each phase of the query '
+                             '(as JSON on stderr)')
+    parser.add_argument('--explain', action='store_true', dest='explain',
+                        default=False,
+                        help='add the query plan to the profile (implies '
+                             '--profile)')
+    parser.add_argument('--profile-file', type=str, dest='profilefile',
+                        metavar='FILE',
+                        help='append the profile to FILE instead of stderr '
+                             '(implies --profile)')
+
+    group = parser.add_argument_group('filter options')
+
+    group.add_argument('-l', action='store', dest='list',
+                       choices=lists,
+                       help='show list by name')
+    group.add_argument('--host', type=str, dest='hostname',
+                       help='device hostname',)
+    group.add_argument('--osname', type=str, dest='osname',
+                       help='operating system name',)
+    group.add_argument('--osver', type=str, dest='osver',
+                       help='operating system version',)
+    group.add_argument('--site', type=str, dest='site',
+                       help='host location',)
+    group.add_argument('--domain', type=str, dest='domain',
+                       help='host domain',)
+    group.add_argument('--model', type=str, dest='model',
+                       help='host hardware model',)
+    group.add_argument('--type', type=str, dest='type',
+                       help='host hardware type',)
+    group.add_argument('--vendor', type=str, dest='vendor',
+                       help='host vendor (manufacturer)',)
+    group.add_argument('--status', type=str, dest='status',
+                       help='host status',)
+    group.add_argument('--entity', type=str, dest='entity',
+                       help='host platform (entity)',)
+    group.add_argument('--user', type=str, dest='user',
+                       help='host owner (user)',)
+    group.add_argument('--group', type=str, dest='group',
+                       help='host department (group)',)
+    group.add_argument('--techuser', type=str, dest='techuser',
+                       metavar='TUSER',
+                       help='host technical owner (user)',)
+    group.add_argument('--techgroup', type=str, dest='techgroup',
+                       metavar='TGROUP',
+                       help='host technical department (group)',)
+    group.add_argument('--software', type=str, dest='software',
+                       metavar='SWNAME',
+                       help='software name',)
+    group.add_argument('--mac', type=str, dest='mac',
+                       help='host MAC address',)
+    group.add_argument('--ip', type=str, dest='ip',
+                       help='host IP address',)
+    group.add_argument('--netmask', type=str, dest='netmask',
+                       help='host netmask address',)
+    group.add_argument('--subnet', type=str, dest='subnet',
+                       help='host subnet address',)
+    group.add_argument('--gateway', type=str, dest='gateway',
+                       help='host default gateway address',)
+    group.add_argument('--case-sensitive', action='store_true', dest='binary',
+                       default=False,
+                       help='case sensite search (does not apply to expr '
+                            'filter)',)
+    group.add_argument('--snapshot', type=str, dest='snapshot',
+                       metavar='FILE',
+                       help='query the local SQLite snapshot instead of the '
+                            'database (see "gethosts sync -h")',)
+    group.add_argument('--backends', type=str, dest='backends',
+                       metavar='NAMES',
+                       help='run the query on the comma separated backends '
+                            'NAMES (or "all") of the backends file in '
+                            'parallel and merge their results',)
+    group.add_argument('--backends-file', type=str, dest='backendsfile',
+                       metavar='FILE', default=BACKENDS,
+                       help='backends file (default is %(default)s)',)
+    group.add_argument('--no-resolve', action='store_true', dest='noresolve',
+                       default=False,
+                       help='match the names of sites, entities, models, etc. '
+                            'in the database instead of the local cache',)
+    group.add_argument('--no-daemon', action='store_true', dest='nodaemon',
+                       default=False,
+                       help='connect to the database even if the daemon is '
+                            'running',)
+    group.add_argument('--cache', type=int, dest='cachettl',
+                       metavar='SECONDS',
+                       help='print the cached result of the same query if it '
+                            'is not older than SECONDS (and cache it '
+                            'otherwise)',)
+    group.add_argument('--no-cache', action='store_true', dest='nocache',
+                       default=False,
+                       help='do not use the result cache',)
+    group.add_argument('--refresh', action='store_true', dest='refresh',
+                       default=False,
+                       help='run the query even if its result is cached (and '
+                            'cache the new result)',)
+    group.add_argument('--chunk-size', type=int, dest='chunksize',
+                       metavar='N',
+                       help='fetch the result in pages of N rows with one '
+                            'short query each (resumed after a lost '
+                            'connection) instead of a single query',)
+    group.add_argument('--batch', type=str, dest='batch', metavar='FILE',
+                       help='run the queries of FILE (- for stdin), one per '
+                            'line, written as gethosts arguments',)
+    group.add_argument('--jobs', type=int, dest='jobs', metavar='N', default=1,
+                       help='number of queries run in parallel in batch mode '
+                            '(default is %(default)s)',)
+    group.add_argument('--complete', nargs=2, dest='complete',
+                       metavar=('LIST', 'PREFIX'),
+                       help='print the cached values of list LIST (or "host") '
+                            'starting with PREFIX (used by bash completion)',)
+    group.add_argument(dest='expr', nargs=argparse.REMAINDER,
+                       metavar='expression',
+                       help='filter criteria expression')
+
+    group = parser.add_argument_group('change feed options')
+    group.add_argument('--since', type=timestamp, dest='since',
+                       metavar='TIMESTAMP',
+                       help='only print the hosts added (+), changed (~) or '
+                            'deleted (-) since TIMESTAMP (YYYY-MM-DD '
+                            '[HH:MM:SS])',)
+    group.add_argument('--state-file', type=str, dest='statefile',
+                       metavar='FILE',
+                       help='read the time of the previous run from FILE '
+                            '(unless --since is given) and save it there',)
+    group.add_argument('--watch', action='store_true', dest='watch',
+                       default=False,
+                       help='keep printing the changes every --interval '
+                            'seconds',)
+    group.add_argument('--interval', type=int, dest='interval',
+                       metavar='SECONDS', default=60,
+                       help='seconds between two runs with --watch '
+                            '(default is %(default)s)',)
+
+    group = parser.add_argument_group('formatting options')
+    group.add_argument('-f', type=str, action='append', dest='field',
+                       choices=field_choices,
+                       help='field to display (multiple options are '
+                            'allowed). ')
+    group.add_argument('--count', action='store_true', dest='count',
+                       default=False,
+                       help='print the number of hosts instead of the hosts')
+    group.add_argument('--group-by', type=field_list, dest='groupby',
+                       metavar='FIELD[,FIELD]',
+                       help='print the number of hosts per value of the comma '
+                            'separated fields (implies --count)')
+    group.add_argument('--inventory', type=field_list, dest='inventory',
+                       metavar='FIELD[,FIELD]',
+                       help='print an Ansible dynamic inventory (JSON) with '
+                            'the hosts grouped by the values of the comma '
+                            'separated fields, and the -f fields as host '
+                            'variables')
+    group.add_argument('--aggregate', action='store_true', dest='aggregate',
+                       default=False,
+                       help='show software and network fields as one comma '
+                            'separated list per host',)
+    group.add_argument('--batch-key', action='store_true', dest='batchkey',
+                       default=False,
+                       help='in batch mode, add the query line as first '
+                            'column instead of a header before each result',)
+    group.add_argument('-s', '--separator', dest='sep', default='\t',
+                       help='output field separator (default is TAB)',)
+    group.add_argument('--no-sort', action='store_true', dest='nosort',
+                       default=False,
+                       help='do not sort the result',)
+    group.add_argument('--show-dups', action='store_true', dest='dups',
+                       default=False,
+                       help='show duplicates in the resulut (if any)',)
+    group.add_argument('--source', action='store_true', dest='source',
+                       default=False,
+                       help='add the backends each row comes from as last '
+                            'column (with --backends)',)
+    group.add_argument('--format', type=str, dest='format',
+                       choices=['jsonl', 'arrow', 'parquet'],
+                       help='print the result as JSON Lines, an Arrow IPC '
+                            'stream or a Parquet file (the last two need '
+                            'pyarrow) with the columns named, instead of '
+                            'TAB or CSV',)
+    group.add_argument('--csv', action='store_true', dest='csv', default=False,
+                       help='Comma Separated Values output (overrides -s '
+                            'unless specified, values are quoted if needed). '
+                            'If result has only one column, output will be '
+                            'displayed on a single line.',)
+
+    sync_parser = argparse.ArgumentParser(
+        prog='%s sync' % parser.prog,
+        description='Copy the GLPI inventory into a local SQLite snapshot.')
+    sync_parser.set_defaults(command='sync')
+
+    sync_parser.add_argument('-d', '--debug', action='store_true',
+                             dest='debug', default=False,
+                             help='enable debug mode (developers only)',)
+    sync_parser.add_argument('--snapshot', type=str, dest='snapshot',
+                             metavar='FILE', default=SNAPSHOT,
+                             help='snapshot file (default is %(default)s)',)
+    sync_parser.add_argument('--full', action='store_true', dest='full',
+                             default=False,
+                             help='copy all rows, not only the changed ones',)
+
+    daemon_parser = argparse.ArgumentParser(
+        prog='%s daemon' % parser.prog,
+        description='Run queries for gethosts over a pool of connections.')
+    daemon_parser.set_defaults(command='daemon')
+
+    daemon_parser.add_argument('-d', '--debug', action='store_true',
+                               dest='debug', default=False,
+                               help='enable debug mode (developers only)',)
+    daemon_parser.add_argument('--socket', type=str, dest='socket',
+                               metavar='PATH', default=DAEMON_SOCKET,
+                               help='Unix socket to listen on '
+                                    '(default is %(default)s)',)
+    daemon_parser.add_argument('--pool', type=int, dest='pool', metavar='N',
+                               default=DAEMON_POOL,
+                               help='number of database connections '
+                                    '(default is %(default)s)',)
+
+    diff_parser = argparse.ArgumentParser(
+        prog='%s diff' % parser.prog,
+        description='Print the hosts added (+), changed (~) or removed (-) '
+                    'between two results saved from gethosts.')
+    diff_parser.set_defaults(command='diff')
+
+    diff_parser.add_argument('-d', '--debug', action='store_true',
+                             dest='debug', default=False,
+                             help='enable debug mode (developers only)',)
+    diff_parser.add_argument('-s', '--separator', dest='sep', default='\t',
+                             help='field separator of the results (default '
+                                  'is TAB)',)
+    diff_parser.add_argument('old', metavar='OLD',
+                             help='older result ("-" for the standard input)',)
+    diff_parser.add_argument('new', metavar='NEW', nargs='?', default='-',
+                             help='newer result (default is the standard '
+                                  'input, to compare with the database)',)
+
+    # The daemon can be run as "gethostsd" (a link to gethosts) too
+    if os.path.basename(sys.argv[0]).startswith('gethostsd'):
+        args = daemon_parser.parse_args()
+    elif sys.argv[1:2] == ['daemon']:
+        args = daemon_parser.parse_args(sys.argv[2:])
+    elif sys.argv[1:2] == ['sync']:
+        args = sync_parser.parse_args(sys.argv[2:])
+    elif sys.argv[1:2] == ['diff']:
+        args = diff_parser.parse_args(sys.argv[2:])
+        if args.old == args.new == '-':
+            diff_parser.error('argument NEW: OLD is the standard input '
+                              'already')
+        if not args.sep:
+            diff_parser.error('argument -s/--separator: must not be empty')
+    else:
+        args = parser.parse_args()
+
+    # Disable traceback if not in debug mode
+    if not args.debug:
+        sys.tracebacklimit = 0
+
 
 # MySQL read-only access
 # mysql> GRANT SELECT ON $DBNAME.* TO $DBUSER@'*' IDENTIFIED BY '$DBPASS';
@@ -167,389 +656,2730 @@ DBUSER = 'DBUSER'
 DBPASS = 'DBPASS'
 DBNAME = 'DBNAME'
 
-# Controls if the query will contain the software and/or network tables
-has_software = False
-has_network = False
 
+def mysql_connect(backend=None):
+    """Import the MySQL driver (on first use) and connect to the database (or
+    to the backend, a dict of connection settings overriding the defaults).
+    """
+
+    global mdb
+    global cursors
+
+    if mdb is None:
+        import warnings
+        import MySQLdb as mdb
+        from MySQLdb import cursors
+
+        # treat MySQL warnings as errors
+        warnings.filterwarnings('error', category=mdb.Warning)
+
+    settings = dict(host=DBSERVER, port=DBPORT, db=DBNAME, user=DBUSER,
+                    passwd=DBPASS)
+    if backend:
+        settings.update(backend)
+
+    # Lists of --aggregate are cut at 1024 bytes by default
+    return mdb.connect(compress=1,
+                       init_command='set session group_concat_max_len = %d'
+                       % (16 << 20), **settings)
+
+
+def mysql_errors():
+    """Return a tuple of the MySQL driver exception class (empty if the
+    driver was not imported, so nothing is caught), to which other
+    exception classes can be added."""
+
+    return (mdb.Error,) if mdb else ()
+
+
+def connect():
+    """Open a connection to the GLPI database, or to the local snapshot if
+    the --snapshot option was given."""
+
+    import sqlite3
+
+    if args.snapshot:
+        # Open read-only so a missing snapshot is an error, not an empty file
+        conn = sqlite3.connect('file:%s?mode=ro' % args.snapshot, uri=True,
+                               check_same_thread=False)
+        if args.binary:
+            conn.execute('pragma case_sensitive_like = 1')
+        return conn
+
+    return mysql_connect()
+
+
+class SeparatorWriter:
+    """CSV writer for the separators of several characters the csv module
+    doesn't take (like the default ", "). Values containing a quote,
+    a line break or a character of the separator (other than a space) are
+    quoted."""
+
+    def __init__(self, out, delimiter):
+        self.out = out
+        self.delimiter = delimiter
+        self.special = frozenset(delimiter.replace(' ', '') or delimiter)
+        self.special |= frozenset('"\r\n')
+        # Times each of them is in the separator
+        self.counts = [(c, delimiter.count(c)) for c in self.special]
+
+    def quote(self, value):
+        value = str(value)
+        if self.special.isdisjoint(value):
+            return value
+        return '"%s"' % value.replace('"', '""')
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        # Most batches need no quotes, which they tell by having no more
+        # special characters than their separators and line breaks. Else
+        # the values are quoted as needed.
+        text = '\n'.join(self.delimiter.join(map(str, row))
+                         for row in rows) + '\n'
+        seps = sum(map(len, rows)) - len(rows)
+        if any(text.count(c) != n * seps + (c == '\n') * len(rows)
+               for c, n in self.counts):
+            text = ''.join(self.delimiter.join(map(self.quote, row)) + '\n'
+                           for row in rows)
+        self.out.write(text)
+
+
+def write_rows(cursor, out, sep, csv, key=None):
+    """Print the rows fetched from cursor to the binary stream out.
+    Rows are fetched and formatted in batches, so each batch is a single
+    write. NULL (and empty) values are printed as NULL, but not zeros (of
+    --count). In CSV, values are quoted as needed and if the result has only
+    one column, all the values are printed on a single line. If key is
+    given, it is added as first column of every row.
+    """
+
+    writer = None
+    buf = None
+    if csv:
+        import csv as csvlib
+
+        # Overrite field separator if output in CSV
+        delimiter = ', ' if sep == '\t' else sep
+        buf = io.StringIO()
+        if len(delimiter) == 1:
+            writer = csvlib.writer(buf, delimiter=delimiter,
+                                   lineterminator='\n')
+        else:
+            writer = SeparatorWriter(buf, delimiter)
+
+    # Is result a single CSV line (and how far in it are we)?
+    single = None
+    first = True
+
+    # Format of a line (for a given number of columns)
+    line = None
+
+    while True:
+        rows = cursor.fetchmany(BATCH)
+        if not rows:
+            break
+        if key is not None:
+            rows = [(key,) + tuple(row) for row in rows]
+
+        if not csv:
+            # Format the whole batch at once
+            if line is None:
+                line = sep.replace('%', '%%').join(['%s'] * len(rows[0]))
+                line += '\n'
+            values = [col if col or col == 0 else 'NULL'
+                      for row in rows for col in row]
+            out.write(((line * len(rows)) % tuple(values)).encode())
+            continue
+
+        rows = [[col if col or col == 0 else 'NULL' for col in row]
+                for row in rows]
+        if single is None:
+            single = len(rows[0]) == 1
+
+        buf.seek(0)
+        buf.truncate()
+        if single:
+            # Use the field separator instead of newline
+            if not first:
+                buf.write(delimiter)
+            writer.writerow([row[0] for row in rows])
+            buf.seek(buf.tell() - 1)
+            buf.truncate()
+        else:
+            writer.writerows(rows)
+        out.write(buf.getvalue().encode())
+        first = False
+
+    # Final newline if output in CSV and there was only one column
+    if single:
+        out.write(b'\n')
+
+
+def write_inventory(cursor, out, shown, groups):
+    """Print the rows fetched from cursor (the hostname, then the values of
+    the fields shown, sorted by hostname) to the binary stream out as an
+    Ansible dynamic inventory. Hosts are put in a group per value of the
+    groups fields (e.g. site_zurich, itself a child of the group site) and
+    the fields shown are their variables (a list for software and network
+    fields). Hosts without a name are skipped. The variables are printed
+    host by host, so only the names of the hosts of each group are kept
+    until the end.
+    """
+
+    import re
+    import json
+
+    # Position of each field in the rows, and whether it has many values
+    columns = [(f, i, chain(fields[f][0]) in multivalued)
+               for i, f in enumerate(shown, 1)]
+
+    # Hosts of each group, by field and group name
+    members = collections.OrderedDict((f, {}) for f in groups)
+
+    def fetch():
+        while True:
+            rows = cursor.fetchmany(BATCH)
+            if not rows:
+                break
+            yield from rows
+
+    out.write(b'{"_meta": {"hostvars": {')
+    sep = '\n'
+    for name, rows in itertools.groupby(fetch(), key=lambda row: row[0]):
+        # Hosts without a name can't be in an inventory (nor a JSON key)
+        if not name:
+            continue
+
+        hostvars = {}
+        for row in rows:
+            for f, i, many in columns:
+                if not row[i]:
+                    continue
+                if not many:
+                    hostvars[f] = row[i]
+                elif row[i] not in hostvars.setdefault(f, []):
+                    hostvars[f].append(row[i])
+
+        for f in groups:
+            values = hostvars.get(f, [])
+            for value in values if isinstance(values, list) else [values]:
+                group = '%s_%s' % (f, re.sub('[^A-Za-z0-9_]', '_',
+                                                     str(value)))
+                hosts = members[f].setdefault(group, [])
+                # Values may give the same group name
+                if not hosts or hosts[-1] != name:
+                    hosts.append(name)
+
+        out.write(('%s  %s: %s' % (sep, json.dumps(name),
+                                   json.dumps(hostvars))).encode())
+        sep = ',\n'
+    out.write(b'}}')
+
+    # The group of each field, then the groups of its values
+    for f, groups in members.items():
+        out.write((',\n %s: %s' % (json.dumps(f), json.dumps(
+            {'children': sorted(groups)}))).encode())
+        for group in sorted(groups):
+            out.write((',\n %s: %s' % (json.dumps(group), json.dumps(
+                {'hosts': groups[group]}))).encode())
+    out.write(b'}\n')
+
+
+def write_jsonl(cursor, out):
+    """Print the rows fetched from cursor to the binary stream out as JSON
+    Lines: one object per row, with the labels of the columns of the query
+    as keys. NULL values are null, and values are printed as they are (a
+    separator in them needs no quoting)."""
+
+    import json
+
+    # Strings (most values) and NULLs are much faster encoded by hand
+    quote = json.encoder.encode_basestring
+    encode = json.JSONEncoder(ensure_ascii=False, default=str).encode
+
+    # Format of a line, with the keys already encoded
+    names = [column[0] for column in cursor.description]
+    line = '{%s}\n' % ', '.join('%s: %%s' % quote(name).replace('%', '%%')
+                                 for name in names)
+
+    while True:
+        rows = cursor.fetchmany(BATCH)
+        if not rows:
+            break
+        values = [quote(col) if col.__class__ is str else
+                  'null' if col is None else encode(col)
+                  for row in rows for col in row]
+        out.write(((line * len(rows)) % tuple(values)).encode())
+
+
+def write_arrow(cursor, out, parquet):
+    """Print the rows fetched from cursor to the binary stream out as an
+    Arrow IPC stream (or a Parquet file if parquet), in record batches of
+    ARROW_BATCH rows converted column by column. The columns are named by
+    the labels of the query, and their types are those of the first batch
+    (strings if they are all NULL, or without rows)."""
+
+    import pyarrow
+
+    names = [column[0] for column in cursor.description]
+    schema = None
+    writer = None
+
+    # pyarrow writes to a file object it can ask the position
+    out = CountingWriter(out)
+
+    def open_writer(schema):
+        if parquet:
+            import pyarrow.parquet
+            return pyarrow.parquet.ParquetWriter(out, schema)
+        import pyarrow.ipc
+        return pyarrow.ipc.new_stream(out, schema)
+
+    try:
+        while True:
+            rows = cursor.fetchmany(ARROW_BATCH)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+
+            if schema is None:
+                arrays = [pyarrow.array(column) for column in columns]
+                arrays = [array.cast(pyarrow.string())
+                          if pyarrow.types.is_null(array.type) else array
+                          for array in arrays]
+                schema = pyarrow.schema([(name, array.type) for name, array
+                                         in zip(names, arrays)])
+                writer = open_writer(schema)
+            else:
+                arrays = [pyarrow.array(column, type=field.type)
+                          for column, field in zip(columns, schema)]
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+
+        # An empty result is still a stream (or file) with the columns
+        if writer is None:
+            writer = open_writer(pyarrow.schema(
+                [(name, pyarrow.string()) for name in names]))
+
+    finally:
+        if writer:
+            writer.close()
+
+
+class RowsCursor:
+    """Cursor-like access (fetchmany only) to rows already fetched (or to an
+    iterator of rows)."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+    def close(self):
+        pass
+
+
+def open_cursor(conn, query, params, statements=None):
+    """Execute a query (with %s placeholders for params) on conn and return
+    the (unbuffered) cursor.
+    If statements is given, MySQL queries are run as server-side prepared
+    statements, which are reused by the next queries of the same template.
+    statements then maps the templates prepared on conn to their names (so
+    there must be one per connection). SQLite already caches statements.
+    """
+
+    import sqlite3
+
+    if isinstance(conn, sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute(query.replace('%s', '?'), params)
+        return cursor
+
+    if statements is None:
+        cursor = conn.cursor(cursors.SSCursor)
+        cursor.execute(query, params)
+        return cursor
+
+    cursor = conn.cursor()
+    name = statements.pop(query, None)
+    if name is None:
+        if len(statements) >= STATEMENTS:
+            # Drop the least recently used one
+            cursor.execute('deallocate prepare %s' % statements.pop(
+                next(iter(statements))))
+        name = 'gethosts_%d' % next(statement_ids)
+        cursor.execute('prepare %s from %%s' % name,
+                       (query.replace('%s', '?'),))
+    statements[query] = name
+
+    variables = ['@gethosts_%d' % i for i in range(len(params))]
+    if params:
+        cursor.execute('set ' + ', '.join(v + ' = %s' for v in variables),
+                       params)
+    cursor.close()
+
+    cursor = conn.cursor(cursors.SSCursor)
+    if params:
+        cursor.execute('execute %s using %s' % (name, ', '.join(variables)))
+    else:
+        cursor.execute('execute %s' % name)
+    return cursor
+
+
+class ChunkedCursor:
+    """Cursor-like access (fetchmany only) to the rows of a query sorted by
+    hostname and host id, the id being the last column (which is not
+    returned). The rows are fetched in pages of size rows, each by a short
+    query starting after the last host of the previous page (keyset
+    pagination). If the connection is lost, a new one is opened and the page
+    fetched again. With distinct, the rows of hosts of the same name are
+    returned once, like a single select distinct without the id would."""
+
+    def __init__(self, conn, query, params, size, distinct,
+                 statements=None):
+        import sqlite3
+
+        # The condition on the key goes at the end of the where clause
+        self.query, order, rest = query.rpartition(' order by ')
+        self.order = order + rest
+        self.conn = conn
+
+        # The hostname as sorted (see build_query()), and its value
+        self.column = 'c.name'
+        self.value = '%s'
+        if isinstance(conn, sqlite3.Connection):
+            self.column = SNAPSHOT_ORDER % 'c.name'
+            self.value = SNAPSHOT_ORDER % '%s'
+        self.params = params
+        self.size = size
+        self.distinct = distinct
+        self.statements = statements
+
+        # Connection opened after losing the one given (closed by close())
+        self.reconnected = None
+
+        # Hostname and id of the last host fetched, the rows of the current
+        # hostname (with distinct) and the rows not returned yet
+        self.key = None
+        self.seen = set()
+        self.rows = []
+        self.done = False
+        self.page()
+
+    def execute(self, query, params):
+        """Fetch all the rows of a (short) query, on a new connection if the
+        current one is lost."""
+
+        for retry in range(CHUNK_RETRIES + 1):
+            try:
+                cursor = open_cursor(self.conn, query, params,
+                                     self.statements)
+                rows = cursor.fetchall()
+                self.description = cursor.description[:-1]
+                cursor.close()
+                return rows
+
+            except mysql_errors() as e:
+                if e.args[0] not in LOST_CONNECTION or retry == CHUNK_RETRIES:
+                    raise
+                if self.reconnected:
+                    self.reconnected.close()
+                self.conn = self.reconnected = mysql_connect()
+                if self.statements is not None:
+                    self.statements = collections.OrderedDict()
+
+    def page(self):
+        """Fetch the rows of the next hosts."""
+
+        query = self.query
+        params = list(self.params)
+        if self.key:
+            name, last = self.key
+            if name is None:
+                # NULL hostnames come first
+                query += ' and (c.name is not null or c.id > %s)'
+                params.append(last)
+            else:
+                query += ' and (%s > %s or (%s = %s and c.id > %%s))' % (
+                    self.column, self.value, self.column, self.value)
+                params += [name, name, last]
+
+        limit = self.size
+        while True:
+            rows = self.execute(query + self.order + ' limit %d' % limit,
+                                params)
+            if len(rows) < limit:
+                self.done = True
+                break
+
+            # The last host may have more rows in the next page, so it is
+            # fetched again there (unless it is alone in a bigger page)
+            last = len(rows)
+            while last and rows[last - 1][-1] == rows[-1][-1]:
+                last -= 1
+            if last:
+                rows = rows[:last]
+                break
+            limit *= 2
+
+        for row in rows:
+            if self.key is None or row[0] != self.key[0]:
+                self.seen = set()
+            self.key = (row[0], row[-1])
+            if self.distinct:
+                if row[:-1] in self.seen:
+                    continue
+                self.seen.add(row[:-1])
+            self.rows.append(row[:-1])
+
+    def fetchmany(self, size):
+        while len(self.rows) < size and not self.done:
+            self.page()
+        rows = self.rows[:size]
+        del self.rows[:size]
+        return rows
+
+    def close(self):
+        if self.reconnected:
+            self.reconnected.close()
+
+
+class ProfiledCursor:
+    """Cursor wrapper recording the rows fetched from another cursor, the
+    time spent fetching them and when the first one arrived."""
+
+    def __init__(self, cursor, profile):
+        self.cursor = cursor
+        self.description = cursor.description
+        self.profile = profile
+        self.start = time.perf_counter()
+
+    def fetchmany(self, size):
+        start = time.perf_counter()
+        rows = self.cursor.fetchmany(size)
+        end = time.perf_counter()
+        self.profile['fetch'] += end - start
+        if rows and self.profile['first_row'] is None:
+            self.profile['first_row'] = end - self.start
+        self.profile['rows'] += len(rows)
+        return rows
+
+    def close(self):
+        self.cursor.close()
+
+
+class CountingWriter:
+    """Binary stream wrapper counting the bytes written to another one (also
+    the position pyarrow asks for, see write_arrow())."""
+
+    closed = False
+
+    def __init__(self, out):
+        self.out = out
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.out.write(data)
+
+    def tell(self):
+        return self.bytes
+
+
+def explain(conn, query, params):
+    """Return the plan of a query as a list of dicts (one per row)."""
+
+    import sqlite3
+
+    cursor = conn.cursor()
+    if isinstance(conn, sqlite3.Connection):
+        cursor.execute('explain query plan ' + query.replace('%s', '?'),
+                       params)
+    else:
+        cursor.execute('explain ' + query, params)
+    names = [col[0] for col in cursor.description]
+    plan = [dict(zip(names, row)) for row in cursor.fetchall()]
+    cursor.close()
+    return plan
+
+
+def run_query(conn, query, params, sep, csv, out, statements=None,
+              profile=None, inventory=None, chunk=None, fmt=None):
+    """Execute a query on conn and print the result to the binary stream out.
+    Database errors are left to the caller. If profile (a dict) is given,
+    the execute, first row, fetch and format times (in seconds) and the
+    number of rows and bytes printed are recorded in it. If inventory (the
+    fields shown and the fields grouped by) is given, the result is printed
+    as an inventory (see write_inventory()). If chunk is given, the result of
+    the query (built with --chunk-size) is fetched in pages of chunk rows
+    (see ChunkedCursor). If fmt (a --format) is given, the result is printed
+    in that format instead of TAB or CSV."""
+
+    def execute():
+        if chunk:
+            return ChunkedCursor(conn, query, params, chunk,
+                                 query.startswith('select distinct'),
+                                 statements)
+        return open_cursor(conn, query, params, statements)
+
+    def write(cursor, out):
+        if inventory:
+            write_inventory(cursor, out, *inventory)
+        elif fmt == 'jsonl':
+            write_jsonl(cursor, out)
+        elif fmt:
+            write_arrow(cursor, out, fmt == 'parquet')
+        else:
+            write_rows(cursor, out, sep, csv)
+
+    if profile is None:
+        cursor = execute()
+        write(cursor, out)
+        cursor.close()
+        return
+
+    profile.update(first_row=None, fetch=0.0, rows=0)
+    start = time.perf_counter()
+    cursor = execute()
+    profile['execute'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cursor = ProfiledCursor(cursor, profile)
+    out = CountingWriter(out)
+    write(cursor, out)
+    cursor.close()
+    elapsed = time.perf_counter() - start
+
+    # Formatting and writing is what was not spent fetching
+    profile['format'] = elapsed - profile['fetch']
+    profile['bytes'] = out.bytes
+    profile['rows_per_second'] = profile['rows'] / elapsed if elapsed else None
+
+
+def write_profile(profile):
+    """Print a profile as one JSON line to stderr (or append it to the
+    --profile-file)."""
+
+    import json
+
+    line = json.dumps(profile, default=str, sort_keys=True) + '\n'
+    if not args.profilefile:
+        sys.stderr.write(line)
+        return
 
-def mysql_run(query, sep, csv):
+    try:
+        # One write, so concurrent runs don't mix their lines
+        fd = os.open(args.profilefile, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                     0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print("Cannot write profile: %s" % e, file=sys.stderr)
+
+
+def mysql_run(query, params, sep, csv, profile=None, out=None,
+              inventory=None, chunk=None, fmt=None, conn=None):
     """Execute a MySQL query and print the result.
     By design, this function handles the MySQL connection, runs the argument
     query and prints the result in the proper format. Again, this is by design!
     The reason why we don't return the result to be printed outside it is
     mainly because the result set might be quite large, thus it is much more
     efficient to just print each line as we fetch the date from the database.
+    If profile (a dict) is given, the connect time, the query plan (with
+    --explain) and the times recorded by run_query are added to it. The
+    result is printed to the binary stream out (stdout by default), as an
+    inventory if inventory is given, in pages of chunk rows if chunk is
+    given and in the format fmt if given (see run_query()). The query runs
+    on conn if given (and closed), else on a new connection.
     """
 
-    conn = None
+    import sqlite3
+
+    if out is None:
+        out = sys.stdout.buffer
 
     try:
-        conn = mdb.connect(host=DBSERVER, port=DBPORT, db=DBNAME,
-                           user=DBUSER, passwd=DBPASS, compress=1)
-        cursor = conn.cursor(cursors.SSCursor)
-        cursor.execute(query)
+        start = time.perf_counter()
+        if conn is None:
+            conn = connect()
+        if profile is not None:
+            profile['connect'] = time.perf_counter() - start
+            if args.explain:
+                profile['explain'] = explain(conn, query, params)
+
+        # Anything printed so far must come before the rows
+        sys.stdout.flush()
+        run_query(conn, query, params, sep, csv, out, profile=profile,
+                  inventory=inventory, chunk=chunk, fmt=fmt)
+        out.flush()
+
+    except mysql_errors() as e:
+        print("MySQL error %d: %s" % (e.args[0], e.args[1]))
+        if profile is not None:
+            profile['error'] = str(e)
+        return ERROR
 
-        # Overrite field separator if output in CSV
-        if csv and sep == '\t':
-            sep = ', '
+    except sqlite3.Error as e:
+        print("SQLite error: %s" % e)
+        if profile is not None:
+            profile['error'] = str(e)
+        return ERROR
+
+    finally:
+        if conn:
+            conn.close()
 
-        # Is first CSV row?
-        first_csv = True
+    return OK
 
-        # Print result using the cursor as iterator
-        for row in cursor:
-            # Is first column?
-            first_col = True
 
-            for col in row:
-                # Make the first iteration a special case
-                if first_col:
-                    first_col = False
-                else:
-                    sys.stdout.write(sep)    # Print field separator
+def daemon_query(path, out=None):
+    """Send the arguments to the daemon listening on path and print the
+    result it streams back (to the binary stream out, stdout by default).
+    Return the exit status of the query, or None if there is no daemon
+    running."""
 
-                # Use the field separator instead of newline
-                if not first_csv:
-                    sys.stdout.write(sep)
+    import json
+    import socket
 
-                # Print NULL if column value is not defined
-                sys.stdout.write(col if col else 'NULL')
+    if out is None:
+        out = sys.stdout.buffer
 
-            # If output in CSV and there is only one column
-            if csv and len(row) == 1:
-                if first_csv:
-                    first_csv = False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        sock.sendall(json.dumps(vars(args)).encode() + b'\n')
+        stream = sock.makefile('rb')
+
+        while True:
+            header = stream.read(FRAME.size)
+            if len(header) < FRAME.size:
+                print("Daemon error: connection closed")
+                return ERROR
+
+            kind, size = FRAME.unpack(header)
+            if kind == b'x':
+                out.flush()
+                return size
+            out.write(stream.read(size))
+
+
+class FrameWriter:
+    """Binary stream sending what is written to it as frames of the daemon
+    protocol: a kind (o for output, x for exit) and the size of the data (or
+    the exit status) followed by the data."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(FRAME.pack(b'o', len(data)) + data)
+
+    def exit(self, status):
+        self.wfile.write(FRAME.pack(b'x', status))
+        self.wfile.flush()
+
+
+class DaemonHandler:
+    """Run the query of one client using a connection of the pool (the
+    handle() method of the socketserver handler of the daemon)."""
+
+    def handle(self):
+        import json
+        import argparse
+
+        out = FrameWriter(self.wfile)
+        request = argparse.Namespace(**json.loads(self.rfile.readline()))
+        error = check_args(request)
+        if error:
+            out.write(("%s: error: %s\n" % (parser.prog, error)).encode())
+            out.exit(ERROR)
+            return
+
+        # Connections come with the statements prepared on them
+        conn, statements = self.server.pool.get()
+        status = ERROR
+        try:
+            if conn is not None:
+                # The server closes idle connections (after wait_timeout), and
+                # so does a --chunk-size query that had to reconnect
+                try:
+                    conn.ping()
+                except mysql_errors():
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = mysql_connect()
+                statements = collections.OrderedDict()
+
+            # Names are resolved to ids on the same connection
+            try:
+                query, params = build_query(
+                    request, None if request.noresolve else lambda: conn)
+            except ExpressionError as e:
+                out.write(("%s: error: argument expression: %s\n" %
+                           (parser.prog, e)).encode())
             else:
-                sys.stdout.write('\n')
+                if request.debug:
+                    out.write(("SQL query: %s\nSQL params: %s\n" %
+                               (query, params)).encode())
+                run_query(conn, query, params, request.sep, request.csv, out,
+                          statements, inventory=inventory_columns(request),
+                          chunk=request.chunksize, fmt=request.format)
+                status = OK
+
+        except mysql_errors() as e:
+            out.write(("MySQL error %d: %s\n" % (e.args[0],
+                                                  e.args[1])).encode())
+            # The connection may be unusable, so open a new one next time
+            if conn:
+                conn.close()
+            conn = None
+
+        except BaseException:
+            # E.g. the client went away (BrokenPipeError), leaving the rest of
+            # the result unread on the connection
+            if conn:
+                conn.close()
+            conn = None
+            raise
+
+        finally:
+            self.server.pool.put((conn, statements))
+
+        out.exit(status)
+
+
+def daemon():
+    """Serve queries on a Unix socket, using a pool of warm connections."""
+
+    import queue
+    import signal
+    import socketserver
+
+    class Handler(DaemonHandler, socketserver.StreamRequestHandler):
+        pass
+
+    server = None
+
+    try:
+        # Remove the socket of a previous daemon (if any)
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+        server = socketserver.ThreadingUnixStreamServer(args.socket, Handler)
+        server.daemon_threads = True
+        os.chmod(args.socket, 0o660)
+
+        server.pool = queue.Queue()
+        for i in range(args.pool):
+            server.pool.put((mysql_connect(), collections.OrderedDict()))
+
+        # Clean up (remove the socket) when stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(OK))
+
+        if args.debug:
+            print("Listening on %s with %d connections" % (args.socket,
+                                                            args.pool))
+        server.serve_forever()
+
+    except mysql_errors() as e:
+        print("MySQL error %d: %s" % (e.args[0], e.args[1]))
+        return ERROR
+
+    except OSError as e:
+        print("Daemon error: %s" % e)
+        return ERROR
+
+    finally:
+        if server:
+            server.server_close()
+            os.unlink(args.socket)
+
+    return OK
 
-        # Final newline if output in CSV and there was only one column
-        if csv and len(row) == 1:
-            sys.stdout.write('\n')
 
+def sync_table(conn, snap, table, columns):
+    """Copy one table into the snapshot.
+    If the table has a date_mod column and was synced before, only the rows
+    modified since the last sync (or without date_mod) are fetched. Rows
+    removed from the database are then dropped by comparing the list of ids
+    (which is cheap to fetch).
+    """
+
+    existing = [row[1] for row in snap.execute('pragma table_info(%s)' %
+                                                table)]
+    if existing and existing != list(columns):
+        # The columns changed (in a new version), so copy the table again
+        snap.execute('drop table %s' % table)
+        snap.execute('delete from gethosts_sync where tablename = ?',
+                     (table,))
+
+    snap.execute('create table if not exists %s (%s, primary key (id))' %
+                 (table, ', '.join(columns)))
+    for column in columns:
+        if column == 'name' or column.endswith('_id'):
+            snap.execute('create index if not exists %s_%s on %s (%s)' %
+                         (table, column, table, column))
+        elif column.endswith('_0'):
+            # The words of an address, matched on ranges (see cidr_condition())
+            words = column[:-2]
+            snap.execute('create index if not exists %s_%s on %s (%s)' %
+                         (table, words, table, ', '.join(
+                             '%s_%d' % (words, i) for i in range(4))))
+
+    if table == 'glpi_computers':
+        # The order of the hostnames (and of the pages of --chunk-size)
+        snap.execute('create index if not exists %s_name_order on %s (%s, id)'
+                     % (table, table, SNAPSHOT_ORDER % 'name'))
+
+    last = None
+    if 'date_mod' in columns and not args.full:
+        row = snap.execute('select date_mod from gethosts_sync'
+                           ' where tablename = ?', (table,)).fetchone()
+        if row:
+            last = row[0]
+
+    # Fetch dates as strings, so they can be compared as-is (with date_mod of
+    # the next sync and with --since)
+    select = 'select %s from %s' % (', '.join(
+        'cast(%s as char)' % c if c.startswith('date_') else c
+        for c in columns), table)
+
+    cursor = conn.cursor(cursors.SSCursor)
+    if last:
+        # Rows without date_mod can't tell when they changed, so they are
+        # always fetched
+        cursor.execute(select + ' where date_mod >= %s or date_mod is null',
+                       (last,))
+    else:
+        snap.execute('delete from %s' % table)
+        cursor.execute(select)
+
+    insert = 'insert or replace into %s values (%s)' % (
+        table, ', '.join('?' * len(columns)))
+    count = 0
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        snap.executemany(insert, rows)
+        count += len(rows)
+    cursor.close()
+
+    if last:
+        snap.execute('delete from gethosts_ids')
+        cursor = conn.cursor(cursors.SSCursor)
+        cursor.execute('select id from %s' % table)
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            snap.executemany('insert into gethosts_ids values (?)', rows)
         cursor.close()
+        snap.execute('delete from %s where id not in'
+                     ' (select id from gethosts_ids)' % table)
+
+    if 'date_mod' in columns:
+        snap.execute('insert or replace into gethosts_sync'
+                     ' select ?, max(date_mod) from %s' % table, (table,))
+
+    if args.debug:
+        print("Synced %s: %d rows%s" % (table, count,
+                                         ' since %s' % last if last else ''))
+
+
+def sync():
+    """Copy the inventory tables into the local snapshot."""
+
+    import sqlite3
+
+    conn = None
+    snap = None
+
+    try:
+        snap = sqlite3.connect(args.snapshot)
+
+        # One transaction, including the changes to the tables (which the
+        # sqlite3 module doesn't start one for)
+        snap.execute('begin')
+        snap.execute('create table if not exists gethosts_sync'
+                     ' (tablename primary key, date_mod)')
+        snap.execute('create temp table gethosts_ids (id primary key)')
+
+        conn = mysql_connect()
+        for table, columns in SNAPSHOT_TABLES.items():
+            sync_table(conn, snap, table, columns)
 
-    except mdb.Error as e:
+        # Statistics for the query planner, without which SQLite prefers
+        # the address indexes even to look up the addresses of each host
+        snap.execute('analyze')
+
+        # Only make the new state visible once all tables are synced
+        snap.commit()
+
+    except mysql_errors() as e:
         print("MySQL error %d: %s" % (e.args[0], e.args[1]))
         return ERROR
 
+    except sqlite3.Error as e:
+        print("SQLite error: %s" % e)
+        return ERROR
+
+    finally:
+        if conn:
+            conn.close()
+        if snap:
+            snap.close()
+
+    return OK
+
+
+def complete_query(name):
+    """Return the query selecting the values of a completion list."""
+
+    if name == 'host':
+        return ('select distinct c.name from glpi_computers as c'
+                ' where c.is_deleted = 0')
+
+    return 'select distinct' + lists[name]
+
+
+def complete_refresh(name, path):
+    """Rebuild the completion cache of a list.
+    The cache is a file with the values sorted (so the prefix lookup can use
+    a binary search) and is replaced atomically. If another process is
+    already refreshing the same list, nothing is done.
+    """
+
+    os.makedirs(CACHEDIR, exist_ok=True)
+    lock = open(path + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return
+
+    conn = None
+    try:
+        conn = connect()
+        cursor = conn.cursor()
+        cursor.execute(complete_query(name))
+        values = sorted(set(row[0] for row in cursor if row[0]))
+        cursor.close()
+
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(''.join('%s\n' % value for value in values))
+        os.replace(tmp, path)
+
     finally:
         if conn:
             conn.close()
+        lock.close()
+
+
+def complete_values(path, prefix):
+    """Print the values of the completion cache file path starting with
+    prefix."""
+
+    with open(path) as f:
+        values = f.read().splitlines()
+
+    # Values are sorted, so the matching ones are all next to each other
+    i = bisect.bisect_left(values, prefix)
+    out = []
+    while i < len(values) and values[i].startswith(prefix):
+        out.append(values[i])
+        i += 1
+    if out:
+        sys.stdout.write('\n'.join(out) + '\n')
+        sys.stdout.flush()
+
+
+def complete(name, prefix):
+    """Print the values of a list starting with prefix, using the on-disk
+    completion cache. A missing cache is built before answering, a stale one
+    is answered from and refreshed in a background process."""
+
+    import sqlite3
+
+    if name != 'host' and name not in lists:
+        parser.error("argument --complete: invalid list: '%s'" % name)
+
+    path = os.path.join(CACHEDIR, 'complete-%s' % name)
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except OSError:
+        try:
+            complete_refresh(name, path)
+        except (sqlite3.Error, OSError) + mysql_errors():
+            return ERROR
+        age = 0
+
+    try:
+        complete_values(path, prefix)
+    except OSError:
+        return ERROR
+
+    if age > COMPLETE_TTL and os.fork() == 0:
+        # Detach from the shell so the completion doesn't wait for us
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            complete_refresh(name, path)
+        finally:
+            os._exit(OK)
 
     return OK
 
 
-def parse_expression(expr, binary):
-    """Parse an expression and converts it to some kind of SQL WHERE clause."""
-
-    global has_software
-    global has_network
-
-    def add_softwares(field, binary):
-        """Translate query field for softwares table."""
-
-        global has_software
-        has_software = True
-        return ' %ssw.%s' % (binary, field)
-
-    def add_networkports(field, binary):
-        """Translate query field for networkports table."""
-
-        global has_network
-        has_network = True
-        return ' %snp.%s' % (binary, field)
-
-    fields = {
-        'host': lambda: ' %sc.name' % binary,   # Accept both host and
-        'hostname': lambda: ' %sc.name' % binary,   # hostname
-        'osname': lambda: ' %sos.name' % binary,
-        'osver': lambda: ' %sosv.name' % binary,
-        'site': lambda: ' %sl.name' % binary,
-        'domain': lambda: ' %sd.name' % binary,
-        'model': lambda: ' %scm.name' % binary,
-        'type': lambda: ' %sct.name' % binary,
-        'vendor': lambda: ' %sm.name' % binary,
-        'status': lambda: ' %ss.name' % binary,
-        'entity': lambda: ' %se.name' % binary,
-        'user': lambda: ' %su.name' % binary,
-        'group': lambda: ' %sg.name' % binary,
-        'techuser': lambda: ' %stu.name' % binary,
-        'techgroup': lambda: ' %stg.name' % binary,
-        'software': lambda: add_softwares('name', binary),
-        'mac': lambda: add_networkports('mac', binary),
-        'ip': lambda: add_networkports('ip', binary),
-        'netmask': lambda: add_networkports('netmask', binary),
-        'subnet': lambda: add_networkports('subnet', binary),
-        'gateway': lambda: add_networkports('gateway', binary),
-    }
-
-    FIELD = 0
-    OP = 1
-    LITERAL = 2
-    CONDOP = 3
-
-    res = ''
-    token = FIELD
-    for i in list(shlex.shlex(expr)):
-        if token == FIELD:
+def result_path(query, params):
+    """Return the result cache file of a query (for the current database and
+    output format)."""
+
+    import hashlib
+
+    key = repr([DBSERVER, DBPORT, DBNAME, args.snapshot, args.binary,
+                query, params, args.sep, args.csv, args.inventory,
+                args.format])
+    return os.path.join(CACHEDIR, 'result-%s' %
+                        hashlib.sha256(key.encode()).hexdigest())
+
+
+def result_read(path, ttl):
+    """Print the cached result in path if it is not older than ttl seconds.
+    Return whether it was printed."""
+
+    try:
+        with open(path, 'rb') as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            if time.time() - mtime > ttl:
+                return False
+
+            # Record the use for the eviction (keeping the age of the result)
+            os.utime(f.fileno(), (time.time(), mtime))
+
+            sys.stdout.flush()
+            for data in iter(lambda: f.read(1 << 16), b''):
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+    except OSError:
+        return False
+
+    return True
+
+
+def result_evict():
+    """Remove the least recently used results until the cache fits in
+    RESULT_CACHE_SIZE. If another process is already doing it, nothing is
+    done."""
+
+    lock = open(os.path.join(CACHEDIR, 'result.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return
+
+    try:
+        now = time.time()
+        results = []
+        total = 0
+        for entry in os.scandir(CACHEDIR):
+            if not entry.name.startswith('result-'):
+                continue
+            try:
+                st = entry.stat()
+                if '.' in entry.name:
+                    # Left behind by a process killed while writing it
+                    if now - st.st_mtime > 86400:
+                        os.remove(entry.path)
+                    continue
+            except OSError:
+                continue
+            results.append((st.st_atime, st.st_size, entry.path))
+            total += st.st_size
+
+        results.sort()
+        for atime, size, path in results:
+            if total <= RESULT_CACHE_SIZE:
+                break
             try:
-                # Try to translate the field in the expression by the DB field
-                i = fields[i]()
-                token = OP
-            except:
-                # If translateion fails, never mind... leave field as expressed
-                # sys.exc_clear()   # this is gone in Python 3
+                os.remove(path)
+            except OSError:
                 pass
-        elif token == OP:
-            if i != 'not':
-                token = LITERAL
-        elif token == LITERAL:
-            # add quotes to the string if not there yet
-            if not (i.startswith('"') or i.startswith("'")):
-                i = "'%s" % i
-            if not (i.endswith('"') or i.endswith("'")):
-                i = "%s'" % i
-            token = CONDOP
-        elif token == CONDOP:
-            token = FIELD
+            total -= size
 
-        res += " %s" % i
+    finally:
+        lock.close()
+
+
+class ResultWriter:
+    """Binary stream wrapper also writing what is written to another one
+    into a new result cache file. The file only replaces the cached result
+    (atomically) on commit. Results larger than RESULT_CACHE_SIZE are not
+    cached."""
+
+    def __init__(self, out, path):
+        self.out = out
+        self.path = path
+        self.tmp = '%s.%d' % (path, os.getpid())
+        self.size = 0
+        try:
+            os.makedirs(CACHEDIR, exist_ok=True)
+            self.file = open(self.tmp, 'wb')
+        except OSError:
+            self.file = None
+
+    def write(self, data):
+        self.out.write(data)
+        if self.file:
+            self.size += len(data)
+            try:
+                if self.size > RESULT_CACHE_SIZE:
+                    self.discard()
+                else:
+                    self.file.write(data)
+            except OSError:
+                self.discard()
+
+    def flush(self):
+        self.out.flush()
+
+    def commit(self):
+        if not self.file:
+            return
+        try:
+            self.file.close()
+            self.file = None
+            os.replace(self.tmp, self.path)
+            result_evict()
+        except OSError:
+            self.discard()
+
+    def discard(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+class ExpressionError(ValueError):
+    """Invalid filter criteria expression."""
+
+
+# Tokens of the expression: quoted strings, parentheses, commas, comparison
+# operators and words (field names, keywords and unquoted values), compiled
+# by tokenize() (the re module keeps it compiled)
+token_pattern = (r"""\s*(?:('[^']*'|"[^"]*")|([(),])|(!=|<>|=)"""
+                 r"""|([^\s(),'"=!<>]+))""")
+
+
+def tokenize(expr):
+    """Split an expression into (kind, text) tokens, kind being one of
+    string, punct, op or word."""
+
+    import re
+
+    token_regex = re.compile(token_pattern)
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = token_regex.match(expr, pos)
+        if not match:
+            raise ExpressionError("unexpected character at: %s" % expr[pos:])
+        pos = match.end()
+        if match.group(1):
+            tokens.append(('string', match.group(1)[1:-1]))
+        elif match.group(2):
+            tokens.append(('punct', match.group(2)))
+        elif match.group(3):
+            tokens.append(('op', match.group(3)))
+        else:
+            tokens.append(('word', match.group(4)))
 
-    return "(%s )" % res
+    return tokens
 
 
-def main():
-    """Parse arguments and run the respective query to GPLI."""
+def parse_expression(tokens):
+    """Parse the tokens of an expression into a tree of tuples:
+    ('or', children), ('and', children), ('not', child), ('const', bool)
+    and ('pred', field, op, values, negated) with op being like, = or in.
 
-    global has_software
-    global has_network
+    The grammar is:
+      expr      := term ('or' term)*
+      term      := factor ('and' factor)*
+      factor    := 'not' factor | '(' expr ')' | predicate
+      predicate := field ['not'] ('like' value | 'in' '(' value (',' value)*
+                   ')' | 'in' value) | field ('=' | '!=' | '<>') value
 
-    def add_softwares(field, alias):
-        """Add query field for softwares table."""
+    A value of an address field (ip, subnet, gateway) compared with = or in
+    can be a network in CIDR notation (e.g. ip in 10.0.0.0/8).
+    """
 
-        global has_software
-        has_software = True
-        return ', sw.%s as "%s"' % (field, alias)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else (None, None)
+
+    def keyword(word):
+        """Consume the keyword word if it is next."""
+
+        nonlocal pos
+        kind, text = peek()
+        if kind == 'word' and text.lower() == word:
+            pos += 1
+            return True
+        return False
+
+    def expect(kind, text=None):
+        nonlocal pos
+        got = peek()
+        if got[0] != kind or text is not None and got[1] != text:
+            raise ExpressionError("expected %s but got %s" % (
+                text or kind, got[1] or 'end of expression'))
+        pos += 1
+        return got[1]
+
+    def value():
+        nonlocal pos
+        kind, text = peek()
+        if kind not in ('string', 'word'):
+            raise ExpressionError("expected a value but got %s" %
+                                  (text or 'end of expression'))
+        pos += 1
+        return text
+
+    def expr():
+        children = [term()]
+        while keyword('or'):
+            children.append(term())
+        return children[0] if len(children) == 1 else ('or', tuple(children))
+
+    def term():
+        children = [factor()]
+        while keyword('and'):
+            children.append(factor())
+        return children[0] if len(children) == 1 else ('and', tuple(children))
+
+    def factor():
+        if keyword('not'):
+            return ('not', factor())
+        if peek() == ('punct', '('):
+            expect('punct', '(')
+            node = expr()
+            expect('punct', ')')
+            return node
+        return predicate()
+
+    def predicate():
+        field = expect('word').lower()
+        field = 'host' if field == 'hostname' else field
+        if field not in fields:
+            raise ExpressionError("unknown field: %s" % field)
+
+        kind, op = peek()
+        if kind == 'op':
+            expect('op')
+            return ('pred', field, '=', (value(),), op != '=')
+
+        negated = keyword('not')
+        if keyword('like'):
+            return ('pred', field, 'like', (value(),), negated)
+        if keyword('in'):
+            if peek() != ('punct', '('):
+                return ('pred', field, 'in', (value(),), negated)
+            expect('punct', '(')
+            values = [value()]
+            while peek() == ('punct', ','):
+                expect('punct', ',')
+                values.append(value())
+            expect('punct', ')')
+            return ('pred', field, 'in', tuple(values), negated)
+
+        raise ExpressionError("expected an operator after %s" % field)
+
+    node = expr()
+    if pos < len(tokens):
+        raise ExpressionError("unexpected %s" % tokens[pos][1])
+    return node
+
+
+def cidr_condition(field, value):
+    """Return the condition (with %s placeholders) and the values matching the
+    addresses of field in value, an address or a network in CIDR notation
+    (e.g. 10.20.0.0/14). The condition is on the words of the address (see
+    addresses), which are equal to those of the network up to its prefix
+    length, then in the range of the network. Return None if value is not
+    an address (e.g. a like pattern)."""
+
+    import ipaddress
+
+    if has_wildcards(value):
+        return None
+    try:
+        network = ipaddress.ip_network(value.strip(), strict=False)
+    except ValueError:
+        return None
+    if network.version == 4:
+        network = ipaddress.IPv6Network('::ffff:%s/%d' % (
+            network.network_address, 96 + network.prefixlen))
+
+    alias, prefix = addresses[field]
+    low = int(network.network_address)
+    high = int(network.broadcast_address)
+    conds = []
+    params = []
+    for i in range(4):
+        shift = 96 - 32 * i
+        first = low >> shift & 0xffffffff
+        last = high >> shift & 0xffffffff
+        column = '%s.%s_%d' % (alias, prefix, i)
+        if first == last:
+            conds.append('%s = %%s' % column)
+            params.append(first)
+            continue
+        # The next words can be anything
+        if (first, last) != (0, 0xffffffff):
+            conds.append('%s between %%s and %%s' % column)
+            params.extend([first, last])
+        break
+
+    if not conds:
+        conds.append('%s.%s_0 is not null' % (alias, prefix))
+    return ' and '.join(conds), params
+
+
+def has_wildcards(value):
+    """Tell if a LIKE pattern has wildcards (or escapes)."""
+
+    return '%' in value or '_' in value or '\\' in value
+
+
+def simplify(node, negate=False):
+    """Rewrite an expression tree (negated if negate):
+    - negations are pushed down to the predicates (De Morgan)
+    - nested and/or are flattened and duplicate children dropped
+    - like without wildcards becomes = (and like '%' a not null check)
+    - several = or in on the same field joined by or become a single in
+    - constant conditions are folded
+    """
+
+    kind = node[0]
+
+    if kind == 'not':
+        return simplify(node[1], not negate)
+
+    if kind == 'const':
+        return ('const', node[1] != negate)
+
+    if kind == 'pred':
+        field, op, values, negated = node[1:]
+        negated = negated != negate
+        if op == 'like' and values[0] == '%':
+            # Any value but NULL matches (and never does if negated)
+            return ('const', False) if negated else ('notnull', field)
+        if op == 'like' and not has_wildcards(values[0]):
+            op = '='
+        if op == 'in' and len(values) == 1:
+            op = '='
+        elif op == '=' and len(values) > 1:
+            op = 'in'
+        return ('pred', field, op, values, negated)
+
+    # and/or, which swap when negated
+    kind = {'and': 'or', 'or': 'and'}[kind] if negate else kind
+    children = []
+    for child in node[1]:
+        child = simplify(child, negate)
+        if child[0] == kind:
+            children.extend(child[1])
+        else:
+            children.append(child)
+
+    # A true child makes an or true and is useless in an and (and vice versa)
+    absorbing = kind == 'or'
+    if ('const', absorbing) in children:
+        return ('const', absorbing)
+    children = [child for child in children if child[0] != 'const']
+
+    if kind == 'or':
+        # Fold the equalities on the same field into a single in
+        equals = {}
+        for child in children:
+            if child[0] == 'pred' and child[2] in ('=', 'in') \
+                    and not child[4]:
+                equals.setdefault(child[1], []).append(child)
+        for field, preds in equals.items():
+            if len(preds) > 1:
+                values = tuple(v for pred in preds for v in pred[3])
+                folded = ('pred', field, 'in', values, False)
+                children[children.index(preds[0])] = folded
+                for pred in preds[1:]:
+                    children.remove(pred)
+
+    # Drop duplicates (keeping the order)
+    children = list(dict.fromkeys(children))
+
+    if not children:
+        return ('const', not absorbing)
+    if len(children) == 1:
+        return children[0]
+    return (kind, tuple(children))
+
+
+def node_chains(node):
+    """Return the tables joined on glpi_computers (see chain(), c for
+    glpi_computers itself) the node filters on."""
+
+    if node[0] in ('pred', 'notnull'):
+        return set([chain(fields[node[1]][0])])
+    if node[0] in ('and', 'or'):
+        return set().union(*(node_chains(c) for c in node[1]))
+    return set()
+
+
+def compile_node(node, binary, collate, semi, aliases, params, inner=None):
+    """Return the SQL condition of an (simplified) expression tree. Filters
+    on the multi-valued tables in semi are run as semi-joins (several of
+    them joined by and are matched on the same row of the table, as with a
+    join). The columns compared are prefixed by binary, and those compared
+    with = or in followed by collate. The aliases used outside the
+    semi-joins are added to aliases and the values to params. inner is the
+    alias set of the semi-join being compiled (if any)."""
+
+    kind = node[0]
+
+    if kind == 'const':
+        return '1 = 1' if node[1] else '1 = 0'
+
+    if kind in ('pred', 'notnull') and inner is None \
+            and node_chains(node) & semi:
+        used = set()
+        cond = compile_node(node, binary, collate, semi, aliases, params,
+                            used)
+        return (semijoin(used, ' ' + cond) + ' )').strip()
+
+    if kind == 'notnull':
+        alias, column = fields[node[1]][:2]
+        (aliases if inner is None or chain(alias) not in semi
+         else inner).add(alias)
+        return '%s.%s is not null' % (alias, column)
+
+    if kind == 'pred':
+        field, op, values, negated = node[1:]
+        alias, column = fields[field][:2]
+        (aliases if inner is None or chain(alias) not in semi
+         else inner).add(alias)
+
+        if op in ('=', 'in') and field in addresses:
+            # Addresses and networks are matched on the words of the address
+            conds = []
+            for value in values:
+                cidr = cidr_condition(field, value)
+                if cidr:
+                    conds.append(cidr[0])
+                    params.extend(cidr[1])
+                else:
+                    conds.append('%s%s.%s%s = %%s' % (binary, alias, column,
+                                                       collate))
+                    params.append(value)
+            conds = ['(%s)' % c if ' and ' in c else c for c in conds]
+            cond = ' or '.join(conds)
+            if negated:
+                return 'not (%s)' % cond
+            return '(%s)' % cond if len(conds) > 1 else cond
+
+        params.extend(values)
+        column = '%s%s.%s' % (binary, alias, column)
+        if op == 'in':
+            return '%s%s %sin (%s)' % (column, collate,
+                                       'not ' if negated else '',
+                                       ', '.join(['%s'] * len(values)))
+        if op == '=':
+            return '%s%s %s %%s' % (column, collate, '!=' if negated else '=')
+        return '%s %slike %%s' % (column, 'not ' if negated else '')
+
+    children = node[1]
+    conds = []
+    if kind == 'and' and inner is None:
+        # The children filtering on the same multi-valued table must match
+        # the same row, so they go in a single semi-join. Those also
+        # filtering on other tables (e.g. an or) have their own semi-joins.
+        groups = {}
+        for child in children:
+            child_chains = node_chains(child)
+            if len(child_chains) == 1 and child_chains <= semi:
+                groups.setdefault(child_chains.pop(), []).append(child)
+            else:
+                conds.append(compile_node(child, binary, collate, semi,
+                                          aliases, params))
+        for group in groups.values():
+            used = set()
+            group = group[0] if len(group) == 1 else ('and', tuple(group))
+            cond = compile_node(group, binary, collate, semi, aliases, params,
+                                used)
+            conds.append((semijoin(used, ' ' + cond) + ' )').strip())
+    else:
+        for child in children:
+            conds.append(compile_node(child, binary, collate, semi, aliases,
+                                      params, inner))
+
+    return '(%s)' % (' %s ' % kind).join(conds)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_normalized(expr, binary, collate, semi):
+    """Compile a normalized expression (see compile_expression()). Return the
+    SQL condition, its values and the aliases it uses."""
+
+    aliases = set()
+    params = []
+    tree = simplify(parse_expression(tokenize(expr)))
+    cond = compile_node(tree, binary, collate, semi, aliases, params)
+    return cond, tuple(params), frozenset(aliases)
+
+
+def compile_expression(expr, binary, collate, semi):
+    """Compile a filter criteria expression into a SQL condition (see
+    compile_node()). The result is cached by the normalized text of the
+    expression, so expressions only differing by spaces, quotes or the case
+    of keywords are compiled once."""
+
+    normalized = []
+    for kind, text in tokenize(expr):
+        if kind == 'string':
+            text = "'%s'" % text if "'" not in text else '"%s"' % text
+        elif kind == 'word' and text.lower() in ('and', 'or', 'not', 'like',
+                                                 'in'):
+            text = text.lower()
+        normalized.append(text)
+
+    return compile_normalized(' '.join(normalized), binary, collate,
+                              frozenset(semi))
+
+
+def like_regex(pattern, binary):
+    """Translate a LIKE pattern to a regular expression. Unless binary, the
+    match ignores case and accents (as the *_unicode_ci collations do)."""
+
+    import re
+
+    regex = ''
+    escape = False
+    for char in pattern:
+        if escape:
+            regex += re.escape(char)
+            escape = False
+        elif char == '\\':
+            escape = True
+        elif char == '%':
+            regex += '.*'
+        elif char == '_':
+            regex += '.'
+        else:
+            regex += re.escape(char)
+
+    return re.compile(regex + r'\Z', 0 if binary else re.IGNORECASE | re.DOTALL)
+
+
+def fold(name):
+    """Remove the accents of name."""
 
-    def add_softwareversions(field, alias):
-        """Add query field for softwareversions table."""
+    return ''.join(c for c in unicodedata.normalize('NFKD', name)
+                   if not unicodedata.combining(c))
 
-        global has_software
-        has_software = True
-        return ', sv.%s as "%s"' % (field, alias)
 
-    def add_networkports(field, alias):
-        """Add query field for networkports table."""
+def host_key(name):
+    """Sort key of a host name, in the order of the database: utf8_unicode_ci
+    (of GLPI) ignores case and accents, and sorts _ before the other
+    punctuation (but after spaces), NULL first. This is only its order for
+    names made of letters, digits, spaces and "_-.", whose other punctuation
+    is sorted by code point. Snapshots are sorted the same way
+    (SNAPSHOT_ORDER), but without ignoring accents."""
 
-        global has_network
-        has_network = True
-        return ', np.%s as "%s"' % (field, alias)
+    name = name or ''
+    return (name if name.isascii() else fold(name)).lower().replace('_', '!')
+
+
+def load_dimension(table, get_conn):
+    """Return the (id, name) rows of a dimension table from the cache.
+    The cache (in memory, and in CACHEDIR to be shared between calls) is
+    kept per database and trusted for DIMENSION_TTL seconds. After that,
+    the latest date_mod and the number of rows of the table are compared
+    with those of the cache, on the connection get_conn() returns, and the
+    rows are fetched again only if they differ."""
+
+    import json
+
+    path = os.path.join(CACHEDIR, 'dimension-%s:%d-%s-%s.json' % (
+        DBSERVER, DBPORT, DBNAME, table))
+
+    with dimension_lock:
+        cache = dimension_cache.get(path)
+        if cache is None:
+            try:
+                with open(path) as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {'checked': 0, 'stamp': None, 'rows': []}
+
+        if time.time() - cache['checked'] > DIMENSION_TTL:
+            cursor = get_conn().cursor()
+            try:
+                cursor.execute('select cast(max(date_mod) as char), count(*)'
+                               ' from %s' % table)
+                stamp = list(cursor.fetchone())
+                if stamp != cache['stamp']:
+                    cursor.execute('select id, name from %s' % table)
+                    cache['rows'] = [list(row) for row in cursor.fetchall()]
+                    cache['stamp'] = stamp
+            finally:
+                cursor.close()
+
+            cache['checked'] = time.time()
+            os.makedirs(CACHEDIR, exist_ok=True)
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, path)
+
+        dimension_cache[path] = cache
+        return cache['rows']
+
+
+def resolve_ids(field, pattern, binary, get_conn):
+    """Return the ids of the rows of the dimension table of field whose name
+    matches the LIKE pattern, or None if they can't be resolved (too many of
+    them, or database error) and the table must be joined. The names are
+    fetched on the connection get_conn() returns if needed (see
+    load_dimension())."""
+
+    try:
+        rows = load_dimension(dimensions[field][0], get_conn)
+    except (OSError,) + mysql_errors():
+        return None
 
-    def add_ipaddresses(field, alias):
-        """Add query field for ipaddresses table."""
+    regex = like_regex(pattern if binary else fold(pattern), binary)
+    ids = [id for id, name in rows
+           if name is not None and regex.match(name if binary else fold(name))]
+    return ids if len(ids) <= MAX_IDS else None
 
-        global has_network
-        has_network = True
-        return ', ip.%s as "%s"' % (field, alias)
 
-    def add_ipnetworks(field, alias):
-        """Add query field for ipaddresses table."""
+def chain(alias):
+    """Return the alias of the table joined on glpi_computers through which
+    the table alias is joined (e.g. csv for sw)."""
 
-        global has_network
-        has_network = True
-        return ', ipn.%s as "%s"' % (field, alias)
+    while alias != 'c' and joins[alias][0] != 'c':
+        alias = joins[alias][0]
+    return alias
+
+
+def join_clause(aliases, root='c'):
+    """Return the joins needed for the aliases set (on top of the root table).
+    The aliases the given ones are joined on are added to the set as well."""
+
+    for alias in list(aliases):
+        while alias != root:
+            aliases.add(alias)
+            alias = joins[alias][0]
+
+    return ''.join(join for alias, (_, join) in joins.items()
+                   if alias in aliases and alias != root)
+
+
+def semijoin(aliases, where):
+    """Return an exists condition matching the hosts with at least one row of
+    a multi-valued table (joined with the tables of aliases) matching where.
+    Unlike a join, this doesn't multiply the rows of the host."""
+
+    root = chain(next(iter(aliases)))
+    table, correlation = multivalued[root]
+    return ' exists (select 1%s%s where %s and%s' % (
+        table, join_clause(set(aliases), root), correlation, where)
+
+
+def aggregate(alias, column, aliases, snapshot):
+    """Return a subquery concatenating the values of a multi-valued column of
+    the host. All the columns of the same multi-valued table are fetched with
+    the same joins (aliases) and order, so their lists are aligned. The
+    subquery is written for SQLite if snapshot is set."""
+
+    root = chain(alias)
+    table, correlation = multivalued[root]
+    aliases = set(aliases)
+    joined = join_clause(aliases, root)
+    value = "coalesce(%s.%s, 'NULL')" % (alias, column)
+    order = ', '.join('%s.id' % a for a in joins
+                      if a == root or a in aliases)
+
+    if snapshot:
+        # SQLite has no order by in group_concat(), but keeps the subquery one
+        return ("(select group_concat(v, ',') from (select %s as v%s%s"
+                " where %s order by %s))" % (value, table, joined,
+                                             correlation, order))
+
+    return ("(select group_concat(%s order by %s separator ',')%s%s"
+            " where %s)" % (value, order, table, joined, correlation))
+
+
+def inventory_columns(args):
+    """Return the fields shown in the --inventory of args (the fields grouped
+    by, then the other -f fields) and the fields grouped by, or None if
+    args is not an inventory."""
+
+    if not args.inventory:
+        return None
+    return (args.inventory + [f for f in args.field or []
+                              if f not in args.inventory], args.inventory)
+
+
+def build_query(args, get_conn=None, changes=False):
+    """Build the query for the parsed arguments args. Return the query, with
+    %s placeholders for the values to match, and the list of values.
+    If get_conn is given, the filters on dimension tables are resolved to ids
+    (see resolve_ids(), get_conn() returning the connection their names are
+    fetched on when needed), so they don't need the join. If changes is set, the
+    query of the change feed is built: the rows start with a change column
+    (+, ~ or -) and, with args.since, only the hosts changed since then are
+    selected (see changes()). With args.count (or args.groupby), the
+    query counts the hosts (per group of values of the args.groupby fields)
+    instead. With args.inventory, the fields grouped by are selected before
+    the other args.field fields (see inventory_columns()). With
+    args.chunksize, the host id is selected as last column and the rows are
+    sorted by hostname and id (see ChunkedCursor)."""
+
+    params = []
+
+    # Number of hosts, or number of hosts per group
+    count = args.count or args.groupby
 
     # Select distinct values if no duplicates
-    if args.dups:
+    if args.dups or count:
         query = 'select'
     else:
         query = 'select distinct'
 
     if args.list:
-        # Build the list from the respective table
-        if args.list in ['ip', 'mac', 'netmask', 'subnet', 'gateway']:
-            query += ' %s from glpi_networkports where itemtype = "%s" and is_recursive = 0' % (
-                args.list, itemtype)
-        else:
-            list = {
-                'osname': lambda: 'glpi_operatingsystems as t',
-                'osver': lambda: 'glpi_operatingsystemversions as t',
-                'site': lambda: 'glpi_locations as t',
-                'domain': lambda: 'glpi_domains as t',
-                'model': lambda: 'glpi_computermodels as t',
-                'type': lambda: 'glpi_computertypes as t',
-                'vendor': lambda: 'glpi_manufacturers as t',
-                'status': lambda: 'glpi_states as t',
-                'entity': lambda: 'glpi_entities as t',
-                'user': lambda: 'glpi_users as t',
-                'group': lambda: 'glpi_groups as t',
-                'techuser': lambda: 'glpi_users as t',
-                'techgroup': lambda: 'glpi_groups as t',
-                'software': lambda: (' glpi_softwareversions as sv,'
-                                     ' glpi_softwares as t'
-                                     ' where sv.softwares_id = t.id'
-                                     ' and t.is_deleted = 0'),
-            }
-            query += ' t.name from ' + list[args.list]()
+        query += lists[args.list]
 
     else:
-        # At least the hostname must be always selected
-        query += ' c.name as "name"'
+        # Added, changed or deleted, as the first column of the feed
+        if changes and args.since:
+            query += (""" case when c.is_deleted = 1 then '-'"""
+                      """ when c.date_creation >= %s then '+'"""
+                      """ else '~' end as "change",""")
+        elif changes:
+            query += """ '+' as "change","""
+
+        # Fields selected: the groups when counting, else the -f fields
+        if count:
+            shown = args.groupby or []
+        elif args.inventory:
+            shown = inventory_columns(args)[0]
+        else:
+            shown = args.field or []
+
+        # Tables referenced by the query (only those will be joined)
+        aliases = set()
+
+        if count:
+            # The values of the group, then the number of hosts
+            columns = ['%s.%s as "%s"' % fields[f] for f in shown]
+            query += ' ' + ', '.join(columns +
+                                     ['count(distinct c.id) as "count"'])
+            aliases.update(fields[f][0] for f in shown)
+        else:
+            # At least the hostname must be always selected
+            query += ' c.name as "name"'
+
+        # Software and network tables have many rows per host. With
+        # --aggregate their fields are fetched per host in subqueries. Else
+        # they are joined, multiplying the rows of the host.
+        selected = set()
+        for f in shown:
+            alias = fields[f][0]
+            if args.aggregate and chain(alias) in multivalued:
+                selected.add(alias)
+
+        # Filters on multi-valued tables which are not joined anyway use a
+        # semi-join (unless duplicates are shown, which would change them)
+        semi = set()
+        if not args.dups or count:
+            semi = set(multivalued) - set(
+                chain(fields[f][0]) for f in shown
+                if not args.aggregate)
 
         # Also select other fields if --field argument(s) have been provided
-        if args.field:
-            field = {
-                'serial': lambda: ', c.serial as "serial"',
-                'uuid': lambda: ', c.uuid as "uuid"',
-                'osname': lambda: ', os.name as "osname"',
-                'osver': lambda: ', osv.name as "osver"',
-                'site': lambda: ', l.name as "location"',
-                'domain': lambda: ', d.name as "domain"',
-                'model': lambda: ', cm.name as "model"',
-                'type': lambda: ', ct.name as "type"',
-                'vendor': lambda: ', m.name as "vendor"',
-                'status': lambda: ', s.name as "status"',
-                'entity': lambda: ', e.name as "entity"',
-                'user': lambda: ', u.name as "user"',
-                'group': lambda: ', g.name as "group"',
-                'techuser': lambda: ', tu.name as "techuser"',
-                'techgroup': lambda: ', tg.name as "techgroup"',
-                'software': lambda: add_softwares('name', 'software'),
-                'swver': lambda: add_softwareversions('name', 'swver'),
-                'ifname': lambda: add_networkports('name', 'ifname'),
-                'mac': lambda: add_networkports('mac', 'mac'),
-                # 'ip':       lambda: add_networkports('ip', 'ip'),
-                'ip': lambda: add_ipaddresses('name', 'ip'),
-                'netmask': lambda: add_ipnetworks('netmask', 'netmask'),
-                'subnet': lambda: add_ipnetworks('address', 'subnet'),
-                'gateway': lambda: add_ipnetworks('gateway', 'gateway'),
-            }
-            for f in args.field:
-                query += field[f]()
-
-        # Set binary search if case-sensitive
-        binary = 'binary ' if args.binary else ''
+        if not count:
+            for f in shown:
+                alias, column, label = fields[f]
+                if alias in selected:
+                    query += ', %s as "%s"' % (
+                        aggregate(alias, column, [a for a in selected
+                                                  if chain(a) == chain(alias)],
+                                  args.snapshot),
+                        label)
+                    continue
+                aliases.add(alias)
+                query += ', %s.%s as "%s"' % (alias, column, label)
+
+            # The key of the pages (with the hostname)
+            if args.chunksize:
+                query += ', c.id as "id"'
+
+        # Set binary search if case-sensitive (the snapshot uses a pragma for
+        # like, and compares with = or in ignoring case unless case-sensitive,
+        # as the database does)
+        binary = 'binary ' if args.binary and not args.snapshot else ''
+        collate = ' collate nocase' if args.snapshot and not args.binary \
+            else ''
 
         # Next build the WHERE clause (do this before the FROM clause because
-        # depending on the search criteria, the "has_ flags" will be set)
+        # depending on the search criteria, more tables need to be joined)
         where = ''
         if args.expr:
-            where += ' and ' + parse_expression(" ".join(args.expr), binary)
-        if args.hostname:
-            where += " and %sc.name like '%s'" % (binary, args.hostname)
-        if args.osname:
-            where += " and %sos.name like '%s'" % (binary, args.osname)
-        if args.osver:
-            where += " and %sosv.name like '%s'" % (binary, args.osver)
-        if args.site:
-            where += " and %sl.name like '%s'" % (binary, args.site)
-        if args.domain:
-            where += " and %sd.name like '%s'" % (binary, args.domain)
-        if args.model:
-            where += " and %scm.name like '%s'" % (binary, args.model)
-        if args.type:
-            where += " and %sct.name like '%s'" % (binary, args.type)
-        if args.vendor:
-            where += " and %sm.name like '%s'" % (binary, args.vendor)
-        if args.status:
-            where += " and %ss.name like '%s'" % (binary, args.status)
-        if args.entity:
-            where += " and %se.name like '%s'" % (binary, args.entity)
-        if args.user:
-            where += " and %su.name like '%s'" % (binary, args.user)
-        if args.group:
-            where += " and %sg.name like '%s'" % (binary, args.group)
-        if args.techuser:
-            where += " and %stu.name like '%s'" % (binary, args.techuser)
-        if args.techgroup:
-            where += " and %stg.name like '%s'" % (binary, args.techgroup)
-        if args.software:
-            has_software = True
-            where += " and %ssw.name like '%s'" % (binary, args.software)
-        if args.ip:
-            has_network = True
-            where += " and %sip.name like '%s'" % (binary, args.ip)
-        if args.mac:
-            has_network = True
-            where += " and %snp.mac like '%s'" % (binary, args.mac)
-        if args.netmask:
-            has_network = True
-            where += " and %sipn.netmask like '%s'" % (binary, args.netmask)
-        if args.subnet:
-            has_network = True
-            where += " and %sipn.address like '%s'" % (binary, args.subnet)
-        if args.gateway:
-            has_network = True
-            where += " and %sipn.gateway like '%s'" % (binary, args.gateway)
-
-        # Rock'n'roll the FROM clause                  table alias down here vvv
-        query += (' from glpi_computers as c'                              # c
-                  ' left join glpi_items_operatingsystems as ios'          # ios
-                  ' on (c.id = ios.items_id)'
-                  ' left join glpi_operatingsystems as os'                 # os
-                  ' on (ios.operatingsystems_id = os.id)'
-                  ' left join glpi_operatingsystemversions as osv'         # osv
-                  ' on (ios.operatingsystemversions_id = osv.id)'
-                  ' left join glpi_locations as l'                         # l
-                  ' on (c.locations_id = l.id)'
-                  ' left join glpi_domains as d'                           # d
-                  ' on (c.domains_id = d.id)'
-                  ' left join glpi_computermodels as cm'                   # cm
-                  ' on (c.computermodels_id = cm.id)'
-                  ' left join glpi_computertypes as ct'                    # ct
-                  ' on (c.computertypes_id = ct.id)'
-                  ' left join glpi_manufacturers as m'                     # m
-                  ' on (c.manufacturers_id = m.id)'
-                  ' left join glpi_states as s on (c.states_id = s.id)'    # s
-                  ' left join glpi_entities as e'                          # e
-                  ' on (c.entities_id = e.id)'
-                  ' left join glpi_users as u on (c.users_id = u.id)'      # u
-                  ' left join glpi_groups as g on (c.groups_id = g.id)'    # g
-                  ' left join glpi_users as tu'                            # tu
-                  ' on (c.users_id_tech = tu.id)'
-                  ' left join glpi_groups as tg'                           # tg
-                  ' on (c.groups_id_tech = tg.id)')
-        if has_software:
-            query += (' left join glpi_computers_softwareversions as csv'  # csv
-                      ' on (c.id = csv.computers_id)'
-                      ' left join glpi_softwareversions as sv'             # sv
-                      ' on (csv.softwareversions_id = sv.id)'
-                      ' left join glpi_softwares as sw'                    # sw
-                      ' on (sv.softwares_id = sw.id)')
-        if has_network:
-            query += (' left join glpi_networkports as np'                 # np
-                      ' on (c.id = np.items_id)'
-                      ' left join glpi_networknames as nn'                 # nn
-                      ' on (np.id = nn.items_id)'
-                      ' left join glpi_ipaddresses as ip'                  # ip
-                      ' on (nn.id = ip.items_id)'
-                      ' left join glpi_ipaddresses_ipnetworks as ian'      # ian
-                      ' on (ip.id = ian.ipaddresses_id)'
-                      ' left join glpi_ipnetworks as ipn'                  # ipn
-                      ' on (ipn.id = ian.ipnetworks_id)')
-
-        query += ' where c.is_deleted = 0'
+            cond, values, used = compile_expression(" ".join(args.expr),
+                                                    binary, collate, semi)
+            where += ' and ' + cond
+            aliases.update(used)
+            params.extend(values)
+        for dest, f in filters:
+            value = getattr(args, dest)
+            ids = None
+            if value and get_conn and f in dimensions:
+                ids = resolve_ids(f, value, args.binary, get_conn)
+            if ids is not None:
+                # Filter on the (indexed) foreign key of the table
+                alias, column = dimensions[f][1:]
+                aliases.add(alias)
+                if ids:
+                    where += ' and %s.%s in (%s)' % (
+                        alias, column, ', '.join(['%s'] * len(ids)))
+                    params.extend(ids)
+                else:
+                    where += ' and 1 = 0'
+            elif value:
+                alias, column = fields[f][:2]
+                cidr = cidr_condition(f, value) if f in addresses else None
+                if cidr:
+                    cond = ' ' + cidr[0]
+                    params.extend(cidr[1])
+                else:
+                    cond = " %s%s.%s like %%s" % (binary, alias, column)
+                    params.append(value)
+                if chain(alias) in semi:
+                    where += ' and' + semijoin(set([alias]), cond) + ' )'
+                else:
+                    aliases.add(alias)
+                    where += ' and' + cond
+
+        # Rock'n'roll the FROM clause with only the tables needed
+        query += ' from glpi_computers as c' + join_clause(aliases)
+
+        if changes and args.since:
+            # Hosts deleted (moved to the trash) since are shown as well, and
+            # any row of the output modified since makes the host changed
+            changed = ['%s.date_mod >= %%s' % alias for alias in modified
+                       if alias == 'c' or alias in aliases]
+            query += (' where (c.is_deleted = 0 or c.date_mod >= %%s) and (%s)'
+                      % ' or '.join(changed))
+
+            # So far, the query only has placeholders for since, and they come
+            # before those of the where clause
+            params[:0] = [args.since] * query.count('%s')
+        else:
+            query += ' where c.is_deleted = 0'
         query += where
 
-        if has_software:
+        if 'csv' in aliases:
             query += ' and csv.is_deleted = 0'
-        if has_network:
-            query += ' and np.itemtype = "%s" and np.is_recursive = 0' % itemtype
+        if 'np' in aliases:
+            query += " and np.itemtype = '%s' and np.is_recursive = 0" % itemtype
+
+        # Labels can't be used: in MySQL, "label" is a string there
+        if count and shown:
+            grouped = ', '.join('%s.%s' % fields[f][:2] for f in shown)
+            query += ' group by ' + grouped
+
+    # Default is to sort by name (or by group when counting). The rows of an
+    # inventory are always sorted, so those of a host are together, and
+    # pages are sorted by their key. A snapshot sorts hostnames like the
+    # database, then with case, so the rows of a host are still together.
+    snapshot = args.snapshot and not args.list
+    order = SNAPSHOT_ORDER % 'c.name' if snapshot else 'name'
+    if count:
+        if shown and not args.nosort:
+            query += ' order by ' + grouped
+    elif args.chunksize:
+        query += ' order by %s, c.id' % order
+    elif args.backends and not args.nosort:
+        # Merged in the same order whatever the collation of each database
+        query += ' order by binary name'
+    elif not args.nosort or args.inventory:
+        query += ' order by ' + order
+        if snapshot:
+            query += ', name'
+
+    return query, params
+
+
+def watermark(conn):
+    """Return the current time of the database (or, for a snapshot, the time
+    of the last modification synced), from which the next changes are
+    fetched."""
+
+    import sqlite3
+
+    cursor = conn.cursor()
+    if isinstance(conn, sqlite3.Connection):
+        cursor.execute('select max(date_mod) from gethosts_sync')
+    else:
+        cursor.execute('select cast(now() as char)')
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0]
+
+
+def changes():
+    """Print the hosts added (+), changed (~) or deleted (-) since --since
+    (or the time saved in the --state-file). Without a starting point, all
+    the hosts are printed as added. The time the changes were fetched at is
+    saved in the --state-file, and with --watch, the changes since then are
+    printed every --interval seconds."""
+
+    import sqlite3
+
+    since = args.since
+    if since is None and args.statefile:
+        try:
+            with open(args.statefile) as f:
+                since = f.read().strip() or None
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            parser.error("argument --state-file: %s" % e)
+
+    conn = None
+
+    try:
+        conn = connect()
+        while True:
+            # Taken first, so changes made while we query are fetched again
+            # next time rather than missed
+            mark = watermark(conn)
+
+            args.since = since
+            query, params = build_query(
+                args, None if args.snapshot or args.noresolve else
+                lambda: conn, True)
+            if args.debug:
+                print("SQL query: %s" % query)
+                print("SQL params: %s" % params)
+
+            sys.stdout.flush()
+            run_query(conn, query, params, args.sep, args.csv,
+                      sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+
+            # End the transaction, so the next run sees the new changes
+            conn.commit()
+
+            since = mark
+            if args.statefile and since:
+                tmp = '%s.%d' % (args.statefile, os.getpid())
+                with open(tmp, 'w') as f:
+                    f.write(since + '\n')
+                os.replace(tmp, args.statefile)
+
+            if not args.watch:
+                break
+            time.sleep(args.interval)
+
+    except mysql_errors() as e:
+        print("MySQL error %d: %s" % (e.args[0], e.args[1]))
+        return ERROR
+
+    except sqlite3.Error as e:
+        print("SQLite error: %s" % e)
+        return ERROR
+
+    except ExpressionError as e:
+        parser.error("argument expression: %s" % e)
+
+    except OSError as e:
+        print("Cannot save state: %s" % e)
+        return ERROR
+
+    finally:
+        if conn:
+            conn.close()
+
+    return OK
+
+
+def load_backends(names):
+    """Return the backends (name and connection settings) of the comma
+    separated names (or all of them) in the backends file."""
+
+    import configparser
+
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        if not config.read(args.backendsfile):
+            parser.error("argument --backends-file: cannot read %s" %
+                         args.backendsfile)
+    except configparser.Error as e:
+        parser.error("argument --backends-file: %s" % e)
+
+    if names == 'all':
+        names = config.sections()
+    else:
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    for name in names:
+        if not config.has_section(name):
+            parser.error("argument --backends: unknown backend: '%s'" % name)
+
+    backends = []
+    for name in names:
+        section = config[name]
+        try:
+            backends.append((name, dict(
+                host=section.get('server', DBSERVER),
+                port=section.getint('port', DBPORT),
+                db=section.get('database', DBNAME),
+                user=section.get('user', DBUSER),
+                passwd=section.get('password', DBPASS))))
+        except ValueError as e:
+            parser.error("argument --backends-file: [%s]: %s" % (name, e))
+    return backends
+
+
+def fetch_backend(name, backend, query, params, out):
+    """Run a query on a backend and put its rows into the queue out, in
+    batches of (name, rows), followed by an empty batch (or by the exception
+    raised)."""
+
+    conn = None
+    try:
+        conn = mysql_connect(backend)
+        cursor = open_cursor(conn, query, params)
+        while True:
+            rows = cursor.fetchmany(BATCH)
+            out.put((name, rows))
+            if not rows:
+                break
+        cursor.close()
+
+    except Exception as e:
+        out.put((name, e))
+
+    finally:
+        if conn:
+            conn.close()
 
-    # Default is to sort by name
-    if not args.nosort:
-        query += ' order by name'
+
+def fanout():
+    """Run the query on several backends in parallel and print their rows.
+    The sorted results are merged by host name as they arrive, otherwise
+    rows are printed in the order they arrive. Rows found in several
+    backends are printed once (unless --show-dups), and with --source, the
+    backends of each row are added as last column. A failing backend is
+    reported and the others are still printed, with a warning status."""
+
+    import heapq
+    import queue
+    import threading
+
+    backends = load_backends(args.backends)
+
+    # Names are not resolved to ids, which are not the same in all databases
+    try:
+        query, params = build_query(args)
+    except ExpressionError as e:
+        parser.error("argument expression: %s" % e)
+
+    if args.debug:
+        print("SQL query: %s" % query)
+        print("SQL params: %s" % params)
+
+    status = OK
+
+    def rows(queue, count):
+        """Yield the (row, backend name) items from a queue fed by count
+        backends."""
+
+        nonlocal status
+        while count:
+            name, batch = queue.get()
+            if isinstance(batch, Exception):
+                if isinstance(batch, mysql_errors()):
+                    print("MySQL error %d: %s (backend %s)" %
+                          (batch.args[0], batch.args[1], name))
+                else:
+                    print("Backend %s error: %s" % (name, batch))
+                status = WARNING
+                count -= 1
+            elif not batch:
+                count -= 1
+            else:
+                for row in batch:
+                    yield tuple(row), name
+
+    def key(item):
+        """Sort key of a row: its host name, in the binary order of the
+        queries (NULL first)."""
+
+        return item[0][0] or ''
+
+    # Each backend has its own queue when its rows are merged. They are
+    # bounded, so a fast backend doesn't pile up rows while we wait for a
+    # slow one.
+    if args.nosort:
+        queues = [queue.Queue(len(backends) * 8)] * len(backends)
+        items = rows(queues[0], len(backends))
+    else:
+        queues = [queue.Queue(8) for _ in backends]
+        items = heapq.merge(*[rows(q, 1) for q in queues], key=key)
+
+    for (name, backend), out in zip(backends, queues):
+        threading.Thread(target=fetch_backend, daemon=True,
+                         args=(name, backend, query, params, out)).start()
+
+    def output():
+        """Yield the rows to print, without duplicates."""
+
+        if args.dups:
+            for row, name in items:
+                yield row + (name,) if args.source else row
+            return
+
+        if args.nosort and not args.source:
+            # Print the rows as they arrive, skipping those already printed
+            seen = set()
+            for row, name in items:
+                if row not in seen:
+                    seen.add(row)
+                    yield row
+            return
+
+        # All the backends of a row are known at the end of its group: the
+        # rows of the same host, or all the rows if they are not sorted
+        if args.nosort:
+            groups = [items]
+        else:
+            groups = (group for _, group in itertools.groupby(items, key))
+        for group in groups:
+            seen = collections.OrderedDict()
+            for row, name in group:
+                seen.setdefault(row, []).append(name)
+            for row, names in seen.items():
+                yield row + (','.join(names),) if args.source else row
+
+    sys.stdout.flush()
+    write_rows(RowsCursor(output()), sys.stdout.buffer, args.sep, args.csv)
+    sys.stdout.buffer.flush()
+    return status
+
+
+class DiffError(ValueError):
+    """Result that can't be compared."""
+
+
+def result_hosts(path, f, sep):
+    """Yield the hosts of a result saved from gethosts (read from the binary
+    stream f) in groups of the same sort key, which differ only in case or
+    accents (so are in any order in the result): (key, hosts) tuples, hosts
+    mapping the names to their lines. Raise DiffError if the result isn't
+    sorted by host name."""
+
+    last = None
+    prefix = None
+    hosts = {}
+    line = b'\n'
+    for number, line in enumerate(f, 1):
+        # The rows of a host follow each other, so the key is only computed
+        # when the host changes
+        if prefix is None or not line.startswith(prefix):
+            if line == b'\n':
+                continue
+            name = line.rstrip(b'\n').split(sep, 1)[0]
+            prefix = name + sep
+            # Compared as UTF-8, which keeps the order of the characters
+            if name.isascii():
+                key = b'' if name == b'NULL' else \
+                    name.lower().replace(b'_', b'!')
+            else:
+                key = host_key(name.decode(errors='replace')).encode()
+            if key != last:
+                if last is not None:
+                    if key < last:
+                        raise DiffError('%s is not sorted by host name '
+                                        '(line %d)' % (path, number))
+                    yield last, hosts
+                last = key
+                hosts = {}
+            append = hosts.setdefault(name, []).append
+        append(line)
+
+    if last is not None:
+        # The last line may have no newline
+        if not line.endswith(b'\n'):
+            hosts[name][-1] += b'\n'
+        yield last, hosts
+
+
+def diff():
+    """Print the hosts added (+), changed (~) or removed (-) from the OLD to
+    the NEW result. Both are read once, merged by host name (they must be
+    sorted, as printed by gethosts), and the rows of a host are compared by
+    their digest, whatever their order. Only the rows of the current hosts
+    are kept, so the memory used doesn't grow with the results (rows in the
+    same order are equal without computing their digests). Added and
+    changed hosts are printed with their new rows, removed hosts with their
+    old rows."""
+
+    import hashlib
+
+    sep = args.sep.encode()
+    out = sys.stdout.buffer
+    status = OK
+    files = []
+
+    def digest(lines):
+        """Digest of the rows of a host, whatever their order."""
+
+        return hashlib.sha256(b''.join(sorted(lines))).digest()
+
+    def write(mark, lines):
+        nonlocal status
+        status = WARNING
+        out.write(b''.join(b'%s%s%s' % (mark, sep, line) for line in lines))
+
+    try:
+        results = []
+        for path in (args.old, args.new):
+            if path == '-':
+                f = sys.stdin.buffer
+            else:
+                f = open(path, 'rb')
+                files.append(f)
+
+            # The first lines tell whether both results have the same fields
+            first = f.readline()
+            results.append((path, first, itertools.chain([first], f)))
+
+        (_, old_first, _), (_, new_first, _) = results
+        if old_first and new_first and \
+                old_first.count(sep) != new_first.count(sep):
+            raise DiffError('%s and %s have different fields' %
+                            (args.old, args.new))
+
+        olds, news = [result_hosts(path, f, sep) for path, _, f in results]
+        old = next(olds, None)
+        new = next(news, None)
+        while old or new:
+            if new is None or old is not None and old[0] < new[0]:
+                for lines in old[1].values():
+                    write(b'-', lines)
+                old = next(olds, None)
+            elif old is None or new[0] < old[0]:
+                for lines in new[1].values():
+                    write(b'+', lines)
+                new = next(news, None)
+            else:
+                for name, lines in old[1].items():
+                    if name not in new[1]:
+                        write(b'-', lines)
+                for name, lines in new[1].items():
+                    if name not in old[1]:
+                        write(b'+', lines)
+                    elif lines != old[1][name] and \
+                            digest(lines) != digest(old[1][name]):
+                        write(b'~', lines)
+                old = next(olds, None)
+                new = next(news, None)
+
+    except DiffError as e:
+        out.flush()
+        print("Diff error: %s" % e)
+        return ERROR
+
+    except OSError as e:
+        out.flush()
+        print("Cannot read result: %s" % e)
+        return ERROR
+
+    finally:
+        for f in files:
+            f.close()
+
+    out.flush()
+    return status
+
+
+# Options a batch line can't use: those of the whole run, and the modes
+# batch() doesn't run (dest and option)
+batch_not_allowed = [
+    ('snapshot', '--snapshot'), ('jobs', '--jobs'),
+    ('batchkey', '--batch-key'), ('complete', '--complete'),
+    ('profile', '--profile'), ('explain', '--explain'),
+    ('profilefile', '--profile-file'), ('cachettl', '--cache'),
+    ('nocache', '--no-cache'), ('refresh', '--refresh'),
+    ('backends', '--backends'), ('backendsfile', '--backends-file'),
+    ('since', '--since'), ('statefile', '--state-file'), ('watch', '--watch'),
+    ('interval', '--interval'), ('chunksize', '--chunk-size'),
+    ('format', '--format'),
+]
+
+
+def batch():
+    """Run the queries of the batch file over one connection (or one per
+    job). Each line holds gethosts arguments; empty lines and lines starting
+    with # are skipped. Queries generating the same SQL are run only once.
+    The results are printed in the order of the file, each one labelled
+    with its line (as a header, or as first column with --batch-key)."""
+
+    import shlex
+    import concurrent.futures
+    import sqlite3
+    import threading
+
+    try:
+        if args.batch == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.batch) as f:
+                lines = f.read().splitlines()
+    except OSError as e:
+        parser.error("argument --batch: %s" % e)
+
+    local = threading.local()
+    conns = []
+
+    def get_conn():
+        """Return the connection of the thread (opened on first use)."""
+
+        if not hasattr(local, 'conn'):
+            local.conn = connect()
+            local.statements = collections.OrderedDict()
+            conns.append(local.conn)
+        return local.conn
+
+    # Parse all the lines first, so an invalid one doesn't stop us halfway.
+    # Names are resolved to ids on the connection of this thread.
+    specs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        spec = parser.parse_args(shlex.split(line))
+        if spec.batch:
+            parser.error("invalid batch line: %s" % line)
+        if spec.inventory and args.batchkey:
+            parser.error('argument --inventory: not allowed with --batch-key')
+        for dest, option in batch_not_allowed:
+            if getattr(spec, dest) != parser.get_default(dest):
+                parser.error('argument %s: not allowed in batch mode' %
+                             option)
+        error = check_args(spec)
+        if error:
+            parser.error('%s (in batch line: %s)' % (error, line))
+        spec.snapshot = args.snapshot
+        try:
+            query, params = build_query(
+                spec, None if spec.snapshot or spec.noresolve else get_conn)
+        except ExpressionError as e:
+            parser.error("argument expression: %s (in batch line: %s)" %
+                         (e, line))
+        specs.append((line, spec, (query, tuple(params))))
+
+    # Number of uses of each query (the rows are kept until the last one)
+    uses = {}
+    for line, spec, query in specs:
+        uses[query] = uses.get(query, 0) + 1
+
+    def get_cursor(query):
+        """Execute a query on the connection of the thread, reusing the
+        statements prepared on it."""
+
+        return open_cursor(get_conn(), query[0], query[1], local.statements)
+
+    def fetch(query):
+        """Fetch all the rows of a query."""
+
+        cursor = get_cursor(query)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    # Fetched rows (or their future if run in parallel) of each query
+    results = {}
+    pool = None
+    if args.jobs > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(args.jobs)
+        for query in uses:
+            results[query] = pool.submit(fetch, query)
+
+    status = OK
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+
+    try:
+        for line, spec, query in specs:
+            if args.debug:
+                out.write(("SQL query: %s\nSQL params: %s\n" %
+                           query).encode())
+            if not args.batchkey:
+                out.write(("# %s\n" % line).encode())
+            key = line if args.batchkey else None
+            uses[query] -= 1
+
+            try:
+                if query in results:
+                    rows = results[query]
+                    if isinstance(rows, concurrent.futures.Future):
+                        rows = results[query] = rows.result()
+                    cursor = RowsCursor(rows)
+                elif uses[query]:
+                    # Keep the rows for the next uses
+                    results[query] = fetch(query)
+                    cursor = RowsCursor(results[query])
+                else:
+                    cursor = get_cursor(query)
+                if spec.inventory:
+                    write_inventory(cursor, out, *inventory_columns(spec))
+                else:
+                    write_rows(cursor, out, spec.sep, spec.csv, key)
+                cursor.close()
+
+            except mysql_errors() as e:
+                out.write(("MySQL error %d: %s\n" % (e.args[0],
+                                                      e.args[1])).encode())
+                status = ERROR
+
+            except sqlite3.Error as e:
+                out.write(("SQLite error: %s\n" % e).encode())
+                status = ERROR
+
+            if not uses[query]:
+                results.pop(query, None)
+
+        out.flush()
+
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        for conn in conns:
+            conn.close()
+
+    return status
+
+
+def run(profile=None, out=None):
+    """Run the query of the arguments (by the daemon if there is one and
+    the query is not profiled) and print the result to the binary stream out
+    (stdout by default). Return the exit status of the query."""
+
+    if profile is not None:
+        start = time.perf_counter()
+
+    # Let the daemon run the query if there is one
+    elif not args.snapshot and not args.nodaemon:
+        res = daemon_query(DAEMON_SOCKET, out)
+        if res is not None:
+            return res
+
+    # Names are resolved to ids on the connection of the query, opened by
+    # then if needed
+    conns = []
+
+    def get_conn():
+        if not conns:
+            conns.append(connect())
+        return conns[0]
+
+    try:
+        query, params = build_query(
+            args, None if args.snapshot or args.noresolve else get_conn)
+    except ExpressionError as e:
+        parser.error("argument expression: %s" % e)
+    conn = conns[0] if conns else None
 
     # Show query if in debug mode
     if args.debug:
         print("SQL query: %s" % query)
+        print("SQL params: %s" % params)
+
+    inventory = inventory_columns(args)
+    if profile is None:
+        return mysql_run(query, params, args.sep, args.csv, out=out,
+                         inventory=inventory, chunk=args.chunksize,
+                         fmt=args.format, conn=conn)
+
+    profile.update(build=time.perf_counter() - start, query=query,
+                   params=params)
+    res = mysql_run(query, params, args.sep, args.csv, profile,
+                    inventory=inventory, chunk=args.chunksize,
+                    fmt=args.format, conn=conn)
+    profile['status'] = res
+    profile['total'] = time.perf_counter() - start
+    write_profile(profile)
+    return res
+
+
+def check_args(spec):
+    """Return the error of the options of spec (the parsed arguments of a
+    query) that can't be used together, or None. Checked by main(), for each
+    line of a batch and by the daemon."""
+
+    if (spec.count or spec.groupby) and (spec.field or spec.list or
+                                         spec.aggregate):
+        return 'argument --count: not allowed with -f, -l or --aggregate'
+
+    if spec.inventory and (spec.list or spec.count or spec.groupby or
+                           spec.aggregate or spec.csv):
+        return ('argument --inventory: not allowed with -l, --count, '
+                '--aggregate or --csv')
+
+    if spec.format:
+        if spec.csv or spec.inventory:
+            return 'argument --format: not allowed with --csv or --inventory'
+        if spec.format != 'jsonl':
+            try:
+                import pyarrow
+            except ImportError:
+                return ('argument --format: %s needs the pyarrow module' %
+                        spec.format)
+
+    if spec.chunksize is not None:
+        if spec.chunksize <= 0:
+            return 'argument --chunk-size: must be a positive number'
+        if spec.list or spec.count or spec.groupby:
+            return 'argument --chunk-size: not allowed with -l or --count'
+
+    if spec.source and not spec.backends:
+        return 'argument --source: only allowed with --backends'
+
+    if spec.backends:
+        if spec.snapshot or spec.since or spec.statefile or spec.watch:
+            return ('argument --backends: not allowed with --snapshot or a '
+                    'change feed')
+        if (spec.count or spec.groupby or spec.inventory or spec.chunksize or
+                spec.format):
+            return ('argument --backends: not allowed with --count, '
+                    '--inventory, --chunk-size or --format')
+
+    if spec.since or spec.statefile or spec.watch:
+        if (spec.list or spec.count or spec.groupby or spec.inventory or
+                spec.chunksize or spec.format):
+            return ('argument --since: not allowed with -l, --count, '
+                    '--inventory, --chunk-size or --format')
+
+    return None
 
-    return mysql_run(query, args.sep, args.csv)
 
+def main():
+    """Parse arguments and run the respective query to GPLI."""
+
+    if (args.complete or args.batch) and (args.profile or args.explain or
+                                          args.profilefile):
+        parser.error('argument --profile: not allowed with --batch or '
+                     '--complete')
+
+    if args.complete:
+        return complete(*args.complete)
+
+    if args.batch:
+        return batch()
+
+    error = check_args(args)
+    if error:
+        parser.error(error)
+
+    if args.backends:
+        return fanout()
+
+    if args.since or args.statefile or args.watch:
+        return changes()
+
+    # The profile is of a local run, so the daemon is not used
+    if args.profile or args.explain or args.profilefile:
+        return run({'time': time.time(), 'argv': sys.argv[1:]})
+
+    ttl = RESULT_TTL if args.cachettl is None else args.cachettl
+    if ttl <= 0 or args.nocache or args.debug:
+        return run()
+
+    # Results are cached by the query built without resolving names to ids,
+    # so a cached result is printed without connecting to the database
+    try:
+        path = result_path(*build_query(args))
+    except ExpressionError as e:
+        parser.error("argument expression: %s" % e)
+    if not args.refresh and result_read(path, ttl):
+        return OK
+
+    out = ResultWriter(sys.stdout.buffer, path)
+    status = ERROR
+    try:
+        status = run(out=out)
+    finally:
+        # Only the results of successful queries are cached
+        if status == OK:
+            out.commit()
+        else:
+            out.discard()
+    return status
+
+
+def cli():
+    """Run the command of the arguments and return its exit status (also
+    called by the gethosts launcher, see there)."""
+
+    # The bash completion runs "gethosts --complete LIST PREFIX" on every
+    # tab, so a fresh cache is answered from before building the argument
+    # parsers (complete() does the rest when it isn't)
+    if len(sys.argv) == 4 and sys.argv[1] == '--complete' and \
+            (sys.argv[2] == 'host' or sys.argv[2] in lists):
+        path = os.path.join(CACHEDIR, 'complete-%s' % sys.argv[2])
+        try:
+            if time.time() - os.stat(path).st_mtime <= COMPLETE_TTL:
+                complete_values(path, sys.argv[3])
+                return OK
+        except OSError:
+            pass
+
+    parse_args()
 
-if __name__ == "__main__":
     try:
-        sys.exit(main())
+        if args.command == 'sync':
+            return sync()
+        if args.command == 'daemon':
+            return daemon()
+        if args.command == 'diff':
+            return diff()
+        return main()
     except KeyboardInterrupt:
         print("Caught Ctrl-C.")
-        sys.exit(ERROR)
+        return ERROR
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Small GLPI snapshot the tests run gethosts on (with --snapshot).
+
+The hosts (see HOSTS) have names differing by case and punctuation, and
+addresses on the boundaries of 10.0.0.0/24. One of them has no network port,
+and two have the same name.
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import ipaddress
+import subprocess
+
+BINDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+
+sys.path.insert(0, BINDIR)
+import gethosts  # noqa: E402
+
+DATE = '2020-04-21 00:00:00'
+
+LOCATIONS = ['LOCATION1', 'Zurich']
+OPERATINGSYSTEMS = ['Linux Debian', 'Windows']
+SOFTWARES = [('openssh', ['7.4', '8.0']), ('nginx', ['1.18'])]
+
+# Name, location, operating system, software versions (by software) and
+# addresses (one port per address) of the hosts
+HOSTS = [
+    ('db000001.example.com', 'LOCATION1', 'Linux Debian',
+     [('openssh', '7.4')], ['10.0.0.0']),
+    ('Db-2.example.com', 'Zurich', 'Linux Debian',
+     [('openssh', '8.0'), ('nginx', '1.18')], ['10.0.0.255']),
+    ('db_1.example.com', 'Zurich', 'Windows', [], ['10.0.1.0']),
+    ('db.example.com', 'LOCATION1', 'Windows', [], ['9.255.255.255']),
+    ('DB3.example.com', 'LOCATION1', 'Linux Debian', [('nginx', '1.18')],
+     []),
+    ('web01.example.com', 'Zurich', 'Linux Debian', [('openssh', '7.4')],
+     ['10.0.0.7', '192.168.1.1']),
+    ('WEB01.example.com', 'Zurich', 'Windows', [], ['10.0.0.8']),
+    ('app.example.com', 'LOCATION1', 'Linux Debian', [('openssh', '7.4')],
+     ['2001:db8::1']),
+    ('app.example.com', 'Zurich', 'Windows', [], ['10.0.0.9']),
+]
+
+
+def words(address):
+    """Return the four 32-bit words GLPI stores for an address (IPv4
+    addresses being mapped into IPv6)."""
+
+    address = ipaddress.ip_address(address)
+    if address.version == 4:
+        address = ipaddress.IPv6Address('::ffff:%s' % address)
+    value = int(address)
+    return tuple(value >> shift & 0xffffffff for shift in (96, 64, 32, 0))
+
+
+def create(path):
+    """Create the snapshot of HOSTS in path."""
+
+    db = sqlite3.connect(path)
+    for table, columns in gethosts.SNAPSHOT_TABLES.items():
+        db.execute('create table %s (%s, primary key (id))' %
+                   (table, ', '.join(columns)))
+
+    def insert(table, rows):
+        db.executemany('insert into %s values (%s)' % (table, ', '.join(
+            '?' * len(gethosts.SNAPSHOT_TABLES[table]))), rows)
+
+    insert('glpi_locations', ((i, name, DATE)
+                              for i, name in enumerate(LOCATIONS, 1)))
+    insert('glpi_operatingsystems', ((i, name, DATE) for i, name in
+                                     enumerate(OPERATINGSYSTEMS, 1)))
+    versions = {}
+    for i, (software, names) in enumerate(SOFTWARES, 1):
+        insert('glpi_softwares', [(i, software, 0, DATE)])
+        for name in names:
+            versions[software, name] = len(versions) + 1
+            insert('glpi_softwareversions',
+                   [(len(versions), i, name, DATE)])
+
+    ports = 0
+    installs = 0
+    for i, (name, site, osname, installed, addresses) in enumerate(HOSTS, 1):
+        insert('glpi_computers', [
+            (i, name, 'SN%d' % i, None, 0, LOCATIONS.index(site) + 1,
+             None, None, None, None, None, None, None, None, None, None,
+             DATE, DATE)])
+        insert('glpi_items_operatingsystems', [
+            (i, i, OPERATINGSYSTEMS.index(osname) + 1, None, DATE)])
+        for version in installed:
+            installs += 1
+            insert('glpi_computers_softwareversions',
+                   [(installs, i, versions[version], 0)])
+        for address in addresses:
+            ports += 1
+            insert('glpi_networkports', [
+                (ports, i, 'Computer', 0, 'eth%d' % ports,
+                 '52:54:00:00:00:%02x' % ports, DATE)])
+            insert('glpi_networknames', [(ports, ports, DATE)])
+            insert('glpi_ipaddresses',
+                   [(ports, ports, address) + words(address)])
+
+    db.commit()
+    db.close()
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """Test case with the snapshot of HOSTS, created once for the class."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='gethosts')
+        cls.snapshot = os.path.join(cls.directory, 'snapshot.db')
+        create(cls.snapshot)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def gethosts(self, *argv, status=0, stdin=None, home=None):
+        """Run gethosts on the snapshot (or gethosts diff, if argv starts
+        with it) and return its output, checking its exit status. The caches
+        go to the directory of the test, unless another home is given."""
+
+        if argv[:1] != ('diff',):
+            argv = ('--snapshot', self.snapshot, '--no-daemon',
+                    '--no-cache') + argv
+
+        env = dict(os.environ, HOME=home or self.directory)
+        proc = subprocess.run(
+            [sys.executable, os.path.join(BINDIR, 'gethosts')] + list(argv),
+            input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=env)
+        self.assertEqual(proc.returncode, status, proc.stderr.decode())
+        return proc.stdout.decode()
+
+    def hosts(self, *argv):
+        """Return the set of hostnames printed by gethosts."""
+
+        return set(self.gethosts(*argv).split())
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Tests of the results fetched in pages (see ChunkedCursor)."""
+
+import json
+import unittest
+
+from snapshot import gethosts, SnapshotTestCase
+
+
+class ChunkedTest(SnapshotTestCase):
+
+    queries = [
+        [],
+        ['-f', 'ip'],
+        ['-f', 'site', '-f', 'osname'],
+        ['--ip', '%'],
+        ['-f', 'software', 'site = zurich or software = openssh'],
+        # Without the hosts of the same name (the variables of the last one
+        # fetched win)
+        ['--inventory', 'site', '-f', 'ip', 'host != app.example.com'],
+    ]
+
+    def check(self, *argv):
+        """Check that argv prints the same rows in pages of any size, and
+        the rows of a single query (whose order of the hosts of the same
+        name differ, which pages sort by id)."""
+
+        whole = self.gethosts(*argv)
+        pages = [self.gethosts('--chunk-size', str(size), *argv)
+                 for size in (1, 2, 3, 1000)]
+        for size, output in zip((2, 3, 1000), pages[1:]):
+            self.assertEqual(output, pages[0], 'chunk size %d' % size)
+
+        if '--inventory' in argv:
+            inventories = [json.loads(output) for output in (pages[0], whole)]
+            for inventory in inventories:
+                for group in inventory.values():
+                    group.get('hosts', []).sort()
+            self.assertEqual(*inventories)
+        else:
+            self.assertEqual(sorted(pages[0].splitlines()),
+                             sorted(whole.splitlines()))
+            names = [line.split('\t')[0] for line in pages[0].splitlines()]
+            self.assertEqual(names, sorted(names, key=gethosts.host_key))
+        return pages[0]
+
+    def test_distinct(self):
+        for argv in self.queries:
+            with self.subTest(argv=argv):
+                self.check(*argv)
+
+    def test_dups(self):
+        for argv in self.queries[:-1]:
+            with self.subTest(argv=argv):
+                self.check('--show-dups', *argv)
+
+    def test_same_name(self):
+        # The rows of both app.example.com, once without duplicates
+        self.assertEqual(
+            [line for line in self.check('-f', 'site').splitlines()
+             if line.startswith('app.')],
+            ['app.example.com\tLOCATION1', 'app.example.com\tZurich'])
+        self.assertEqual(self.check('host = app.example.com'),
+                         'app.example.com\n')
+        self.assertEqual(self.check('--show-dups', 'host = app.example.com'),
+                         'app.example.com\napp.example.com\n')
+
+    def test_dups_rows(self):
+        # web01 is joined on its two network ports
+        self.assertEqual(self.check('--show-dups', '--ip', '%',
+                                    '--case-sensitive', '--host', 'web01%'),
+                         'web01.example.com\nweb01.example.com\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Tests of the filters on addresses and networks (see cidr_condition())."""
+
+import unittest
+
+from snapshot import gethosts, SnapshotTestCase
+
+
+class ConditionTest(unittest.TestCase):
+
+    def test_network(self):
+        self.assertEqual(gethosts.cidr_condition('ip', '10.0.0.0/24'),
+                         ('ip.binary_0 = %s and ip.binary_1 = %s and'
+                          ' ip.binary_2 = %s and ip.binary_3 between %s and'
+                          ' %s', [0, 0, 0xffff, 0x0a000000, 0x0a0000ff]))
+
+    def test_address(self):
+        self.assertEqual(gethosts.cidr_condition('gateway', '10.0.0.1'),
+                         ('ipn.gateway_0 = %s and ipn.gateway_1 = %s and'
+                          ' ipn.gateway_2 = %s and ipn.gateway_3 = %s',
+                          [0, 0, 0xffff, 0x0a000001]))
+
+    def test_ipv6(self):
+        self.assertEqual(gethosts.cidr_condition('subnet', '2001:db8::/32'),
+                         ('ipn.address_0 = %s', [0x20010db8]))
+        self.assertEqual(gethosts.cidr_condition('ip', '::/0'),
+                         ('ip.binary_0 is not null', []))
+
+    def test_host_bits(self):
+        # Not strict: the bits after the prefix are ignored
+        self.assertEqual(gethosts.cidr_condition('ip', '10.0.0.7/24'),
+                         gethosts.cidr_condition('ip', '10.0.0.0/24'))
+
+    def test_not_address(self):
+        for value in ['10.0.0.%', '10.0.0._', 'localhost', '10.0.0.0/33']:
+            with self.subTest(value=value):
+                self.assertIsNone(gethosts.cidr_condition('ip', value))
+
+
+class SnapshotTest(SnapshotTestCase):
+
+    # Hosts with an address in 10.0.0.0/24 (the first and last ones
+    # included), and the others with an IPv4 address
+    network = set(['db000001.example.com', 'Db-2.example.com',
+                   'web01.example.com', 'WEB01.example.com',
+                   'app.example.com'])
+    others = set(['db_1.example.com', 'db.example.com'])
+
+    def test_equal(self):
+        self.assertEqual(self.hosts('--ip', '10.0.0.0/24'), self.network)
+        self.assertEqual(self.hosts('ip = 10.0.0.0/24'), self.network)
+        self.assertEqual(self.hosts('ip = 10.0.0.255'),
+                         set(['Db-2.example.com']))
+        self.assertEqual(self.hosts('ip = "2001:db8::/32"'),
+                         set(['app.example.com']))
+
+    def test_in(self):
+        self.assertEqual(self.hosts('ip in (10.0.1.0/31, 9.255.255.255)'),
+                         self.others)
+        self.assertEqual(self.hosts('ip in 0.0.0.0/0'),
+                         self.network | self.others)
+        self.assertEqual(self.hosts('ip in (10.0.0.0/31, 10.0.0.255/32,'
+                                    ' 10.0.1.1/32)'),
+                         set(['db000001.example.com', 'Db-2.example.com']))
+
+    def test_not(self):
+        # The hosts with another address (web01 also has one in 192.168/16)
+        # or, for the second app.example.com, an IPv6 address
+        self.assertEqual(self.hosts('not ip = 10.0.0.0/24'),
+                         self.others | set(['web01.example.com',
+                                            'app.example.com']))
+        self.assertEqual(self.hosts('ip not in (10.0.0.0/24, 192.168.0.0/16,'
+                                    ' 9.0.0.0/8)'),
+                         set(['db_1.example.com', 'app.example.com']))
+        self.assertEqual(self.hosts('ip = 10.0.0.0/24 and'
+                                    ' not ip = 10.0.0.0/25'),
+                         set(['Db-2.example.com']))
+
+    def test_boundaries(self):
+        self.assertEqual(self.hosts('ip = 10.0.0.0/32'),
+                         set(['db000001.example.com']))
+        self.assertEqual(self.hosts('ip = 10.0.0.128/25'),
+                         set(['Db-2.example.com']))
+        self.assertEqual(self.hosts('ip = 9.255.255.255/32'),
+                         set(['db.example.com']))
+        self.assertEqual(self.hosts('ip = 10.0.1.0/24'),
+                         set(['db_1.example.com']))
+        self.assertEqual(self.hosts('ip = 10.0.0.0/23'),
+                         self.network | set(['db_1.example.com']))
+        self.assertEqual(self.hosts('ip = 8.0.0.0/7'),
+                         set(['db.example.com']))
+
+    def test_like(self):
+        # Not an address: matched on the text
+        self.assertEqual(self.hosts('--ip', '10.0.0.%'), self.network)
+        self.assertEqual(self.hosts('ip like "10.0.0._"'),
+                         set(['db000001.example.com', 'web01.example.com',
+                              'WEB01.example.com', 'app.example.com']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Tests of the completion of list values (see complete())."""
+
+import os
+import unittest
+
+from snapshot import SnapshotTestCase
+
+
+class CompleteTest(SnapshotTestCase):
+
+    def test_values(self):
+        self.assertEqual(self.gethosts('--complete', 'site', 'LOC'),
+                         'LOCATION1\n')
+        self.assertEqual(self.gethosts('--complete', 'host', 'db_'),
+                         'db_1.example.com\n')
+
+    def test_no_cache(self):
+        # The cache directory can't be created: no values, but no traceback
+        home = os.path.join(self.directory, 'home')
+        os.mkdir(home)
+        open(os.path.join(home, '.cache'), 'w').close()
+        self.assertEqual(self.gethosts('--complete', 'site', 'LOC',
+                                       status=2, home=home), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
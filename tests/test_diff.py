@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Tests of gethosts diff (see diff())."""
+
+import os
+import shutil
+import sqlite3
+import unittest
+
+from snapshot import gethosts, SnapshotTestCase
+
+
+class HostKeyTest(unittest.TestCase):
+
+    names = ['a-b', 'a_b', 'a.b', 'A_c', 'ab', 'a b', 'a0', 'A-B', 'a',
+             'a_', 'a-', 'web01', 'WEB01', 'web-01', 'web_01', 'web.01',
+             'Web1', 'db_1.example.com', 'Db-2.example.com', 'db.example.com',
+             'db000001.example.com', 'DB3.example.com']
+
+    def test_snapshot_order(self):
+        # The order of the snapshot, ties (names equal but for case) aside
+        db = sqlite3.connect(':memory:')
+        db.execute('create table t (name)')
+        db.executemany('insert into t values (?)', [(n,) for n in self.names])
+        ordered = [name for name, in db.execute(
+            'select name from t order by %s' %
+            (gethosts.SNAPSHOT_ORDER % 'name'))]
+        keys = [gethosts.host_key(name) for name in ordered]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_punctuation(self):
+        # As in utf8_unicode_ci: space, then _, then the other punctuation
+        # (-, .), then digits and letters
+        self.assertEqual(sorted(['a-b', 'a.b', 'a_b', 'a b', 'a0', 'ab'],
+                                key=gethosts.host_key),
+                         ['a b', 'a_b', 'a-b', 'a.b', 'a0', 'ab'])
+
+    def test_case(self):
+        self.assertEqual(gethosts.host_key('WEB01'),
+                         gethosts.host_key('web01'))
+        self.assertEqual(gethosts.host_key(None), '')
+
+
+class DiffTest(SnapshotTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        # A newer snapshot: db_1 moved, Db-2 replaced by db-2 (another host,
+        # of a name only differing by case) and web_01 added
+        cls.newer = os.path.join(cls.directory, 'newer.db')
+        shutil.copy(cls.snapshot, cls.newer)
+        db = sqlite3.connect(cls.newer)
+        db.execute("update glpi_computers set locations_id = 1"
+                   " where name = 'db_1.example.com'")
+        db.execute("delete from glpi_computers"
+                   " where name = 'Db-2.example.com'")
+        db.executemany("insert into glpi_computers (id, name, is_deleted,"
+                       " locations_id) values (?, ?, 0, 2)",
+                       [(20, 'db-2.example.com'), (21, 'web_01.example.com')])
+        db.commit()
+        db.close()
+
+    def save(self, name, *argv):
+        """Save the output of gethosts in the file name and return its path.
+        """
+
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(self.gethosts(*argv))
+        return path
+
+    def test_same(self):
+        old = self.save('same', '-f', 'site', '-f', 'ip')
+        self.assertEqual(self.gethosts('diff', old, old), '')
+
+    def test_changes(self):
+        old = self.save('old', '-f', 'site')
+        self.snapshot, snapshot = self.newer, self.snapshot
+        try:
+            new = self.save('new', '-f', 'site')
+        finally:
+            self.snapshot = snapshot
+
+        self.assertEqual(self.gethosts('diff', old, new, status=1),
+                         '~\tdb_1.example.com\tLOCATION1\n'
+                         '-\tDb-2.example.com\tZurich\n'
+                         '+\tdb-2.example.com\tZurich\n'
+                         '+\tweb_01.example.com\tZurich\n')
+
+        # The newer result from the standard input
+        with open(new, 'rb') as f:
+            self.assertEqual(self.gethosts('diff', old, stdin=f.read(),
+                                           status=1).count('\n'), 4)
+
+    def test_rows(self):
+        # The rows of a host are compared whatever their order
+        old = self.save('rows', '-f', 'ip')
+        with open(old) as f:
+            lines = f.read().splitlines()
+        index = lines.index('web01.example.com\t10.0.0.7')
+        lines[index:index + 2] = lines[index + 1], lines[index]
+        self.assertEqual(self.gethosts('diff', old, '-', status=0,
+                                       stdin='\n'.join(lines + ['']).encode()),
+                         '')
+
+    def test_unsorted(self):
+        # Sorted by code point, DB3 comes before app
+        old = self.save('unsorted', '-f', 'site')
+        with open(old) as f:
+            lines = sorted(f.read().splitlines())
+        self.gethosts('diff', old, '-', stdin='\n'.join(lines).encode(),
+                      status=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Tests of the filter criteria expressions (see compile_expression())."""
+
+import unittest
+
+from snapshot import gethosts, SnapshotTestCase
+
+ExpressionError = gethosts.ExpressionError
+
+
+def parse(expr):
+    return gethosts.parse_expression(gethosts.tokenize(expr))
+
+
+def simplify(expr):
+    return gethosts.simplify(parse(expr))
+
+
+class TokenizeTest(unittest.TestCase):
+
+    def test_tokens(self):
+        self.assertEqual(
+            gethosts.tokenize('''host like "web%" and ip in (10.0.0.0/8,'''
+                              ''' '1.2.3.4')or not site<>x'''),
+            [('word', 'host'), ('word', 'like'), ('string', 'web%'),
+             ('word', 'and'), ('word', 'ip'), ('word', 'in'),
+             ('punct', '('), ('word', '10.0.0.0/8'), ('punct', ','),
+             ('string', '1.2.3.4'), ('punct', ')'), ('word', 'or'),
+             ('word', 'not'), ('word', 'site'), ('op', '<>'),
+             ('word', 'x')])
+
+    def test_quotes(self):
+        self.assertEqual(gethosts.tokenize('''"it's" 'say "hi"' '''),
+                         [('string', "it's"), ('string', 'say "hi"')])
+
+    def test_errors(self):
+        for expr in ['host = "web', 'host ! x', 'host < a']:
+            with self.subTest(expr=expr):
+                self.assertRaises(ExpressionError, gethosts.tokenize, expr)
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_precedence(self):
+        self.assertEqual(parse('host = a or site like b and not osname in c'),
+                         ('or', (('pred', 'host', '=', ('a',), False),
+                                 ('and', (('pred', 'site', 'like', ('b',),
+                                           False),
+                                          ('not', ('pred', 'osname', 'in',
+                                                   ('c',), False)))))))
+
+    def test_parentheses(self):
+        self.assertEqual(parse('(host = a or host != b) AND ip NOT IN (c, d)'),
+                         ('and', (('or', (('pred', 'host', '=', ('a',),
+                                           False),
+                                          ('pred', 'host', '=', ('b',),
+                                           True))),
+                                  ('pred', 'ip', 'in', ('c', 'd'), True))))
+
+    def test_hostname(self):
+        self.assertEqual(parse('HostName like a'),
+                         ('pred', 'host', 'like', ('a',), False))
+
+    def test_errors(self):
+        for expr, error in [('color = red', 'unknown field: color'),
+                            ('host', 'expected an operator after host'),
+                            ('host like', 'expected a value but got end of'
+                                          ' expression'),
+                            ('(host = a', 'expected ) but got end of'
+                                          ' expression'),
+                            ('host = a b', 'unexpected b'),
+                            ('host == a', 'expected a value but got ='),
+                            ('host in (a b)', 'expected ) but got b')]:
+            with self.subTest(expr=expr):
+                with self.assertRaises(ExpressionError) as cm:
+                    parse(expr)
+                self.assertEqual(str(cm.exception), error)
+
+
+class SimplifyTest(unittest.TestCase):
+
+    def test_de_morgan(self):
+        self.assertEqual(simplify('not (host = a or not site = b)'),
+                         ('and', (('pred', 'host', '=', ('a',), True),
+                                  ('pred', 'site', '=', ('b',), False))))
+
+    def test_like(self):
+        self.assertEqual(simplify('host like web01'),
+                         ('pred', 'host', '=', ('web01',), False))
+        self.assertEqual(simplify('host like "web_1"'),
+                         ('pred', 'host', 'like', ('web_1',), False))
+        self.assertEqual(simplify('host like "%"'), ('notnull', 'host'))
+        self.assertEqual(simplify('host not like "%"'), ('const', False))
+
+    def test_in(self):
+        self.assertEqual(simplify('site in (a)'),
+                         ('pred', 'site', '=', ('a',), False))
+        self.assertEqual(simplify('site = a or host = c or site in (b, a)'),
+                         ('or', (('pred', 'site', 'in', ('a', 'b', 'a'),
+                                  False),
+                                 ('pred', 'host', '=', ('c',), False))))
+
+    def test_flatten(self):
+        self.assertEqual(simplify('host = a and (site = b and host = a)'),
+                         ('and', (('pred', 'host', '=', ('a',), False),
+                                  ('pred', 'site', '=', ('b',), False))))
+
+    def test_constants(self):
+        self.assertEqual(simplify('host = a or host not like "%"'),
+                         ('pred', 'host', '=', ('a',), False))
+        self.assertEqual(simplify('host = a and host not like "%"'),
+                         ('const', False))
+
+
+class CompileTest(unittest.TestCase):
+
+    semi = frozenset(gethosts.multivalued)
+
+    def test_cache(self):
+        self.assertIs(
+            gethosts.compile_expression('host like "a" AND site = b', '', '',
+                                        self.semi),
+            gethosts.compile_expression("host  like 'a' and site = b", '', '',
+                                        self.semi))
+
+    def test_same_row(self):
+        # Both conditions on a single row of the software (semi-join)
+        cond, params, aliases = gethosts.compile_expression(
+            'software = openssh and swver like "7.%" and host = a', '', '',
+            self.semi)
+        self.assertEqual(cond.count('exists'), 1)
+        self.assertEqual(params, ('a', 'openssh', '7.%'))
+        self.assertEqual(aliases, frozenset(['c']))
+
+    def test_mixed_or(self):
+        # The or also filters on the site, so it isn't run in the semi-join
+        # of the network ports (which a host without any would fail)
+        cond, params, aliases = gethosts.compile_expression(
+            'ip = 10.0.0.1 and (site = a or ifname = eth0)', '', '',
+            self.semi)
+        self.assertEqual(cond.count('exists'), 2)
+        self.assertIn(' or exists', cond)
+        self.assertEqual(aliases, frozenset(['l']))
+
+    def test_collate(self):
+        cond, params, aliases = gethosts.compile_expression(
+            'host = a and site in (b, c) and osname like d%', '',
+            ' collate nocase', self.semi)
+        self.assertEqual(cond, '(c.name collate nocase = %s and l.name'
+                               ' collate nocase in (%s, %s) and os.name'
+                               ' like %s)')
+
+    def test_binary(self):
+        cond, params, aliases = gethosts.compile_expression(
+            'host != a or site not like b%', 'binary ', '', self.semi)
+        self.assertEqual(cond, '(binary c.name != %s or binary l.name'
+                               ' not like %s)')
+
+
+class SnapshotTest(SnapshotTestCase):
+
+    def test_mixed_or(self):
+        # DB3 has no network port
+        self.assertIn('DB3.example.com',
+                      self.hosts('site = LOCATION1 or ip = 10.0.0.7'))
+        self.assertEqual(self.hosts('host = DB3.example.com and'
+                                    ' (site = LOCATION1 or ip = 10.0.0.7)'),
+                         set(['DB3.example.com']))
+
+    def test_same_row(self):
+        self.assertEqual(self.hosts('software = nginx and swver = 1.18'),
+                         set(['Db-2.example.com', 'DB3.example.com']))
+        self.assertEqual(self.hosts('software = nginx and swver = 8.0'),
+                         set())
+
+    def test_case(self):
+        location1 = set(['db000001.example.com', 'db.example.com',
+                         'DB3.example.com', 'app.example.com'])
+        self.assertEqual(self.hosts('--site', 'location1'), location1)
+        self.assertEqual(self.hosts('site like location1'), location1)
+        self.assertEqual(self.hosts('site in (location1, nowhere)'),
+                         location1)
+        self.assertEqual(self.hosts('host like DB000001.EXAMPLE.COM'),
+                         set(['db000001.example.com']))
+        self.assertEqual(self.hosts('host = web01.example.com'),
+                         set(['web01.example.com', 'WEB01.example.com']))
+        self.assertEqual(self.hosts('--case-sensitive',
+                                    'host like DB000001.EXAMPLE.COM'), set())
+        self.assertEqual(self.hosts('--case-sensitive',
+                                    'host = web01.example.com'),
+                         set(['web01.example.com']))
+
+    def test_error(self):
+        self.gethosts('host = (a', status=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
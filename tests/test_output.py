@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Tests of the TAB and CSV output (see write_rows())."""
+
+import unittest
+
+from snapshot import SnapshotTestCase
+
+
+class OutputTest(SnapshotTestCase):
+
+    def test_tab(self):
+        self.assertEqual(self.gethosts('--site', 'zurich', '-f', 'site'),
+                         'app.example.com\tZurich\n'
+                         'db_1.example.com\tZurich\n'
+                         'Db-2.example.com\tZurich\n'
+                         'WEB01.example.com\tZurich\n'
+                         'web01.example.com\tZurich\n')
+
+    def test_csv(self):
+        # Separated by ", " as in gethosts 2.0
+        self.assertEqual(self.gethosts('--csv', '--site', 'zurich', '-f',
+                                       'site'),
+                         'app.example.com, Zurich\n'
+                         'db_1.example.com, Zurich\n'
+                         'Db-2.example.com, Zurich\n'
+                         'WEB01.example.com, Zurich\n'
+                         'web01.example.com, Zurich\n')
+        self.assertEqual(self.gethosts('--csv', 'host like "db%"'),
+                         'db_1.example.com, Db-2.example.com, db.example.com,'
+                         ' db000001.example.com, DB3.example.com\n')
+
+    def test_separator(self):
+        self.assertEqual(self.gethosts('--csv', '-s', ';', '--site', 'zurich',
+                                       '-f', 'osname', 'host like "%-%"'),
+                         'Db-2.example.com;Linux Debian\n')
+        self.assertEqual(self.gethosts('--csv', '-s', ' | ', '-f', 'osname',
+                                       '-f', 'site', 'site = zurich and'
+                                       ' osname = windows'),
+                         'app.example.com | Windows | Zurich\n'
+                         'db_1.example.com | Windows | Zurich\n'
+                         'WEB01.example.com | Windows | Zurich\n')
+
+    def test_quotes(self):
+        self.assertEqual(self.gethosts('--csv', '-s', '.', '-f', 'site',
+                                       'host = db.example.com'),
+                         '"db.example.com".LOCATION1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()